@@ -288,16 +288,19 @@ def list_var(ctx, dbname, fname, alias, version):
     with open(fname, 'r') as csvfile:
         reader = csv.reader(csvfile, delimiter=';')
         rows = list(reader)
+    # load mapping table once to match variables
+    mapidx = MappingIndex(conn)
     # return lists of fully/partially matching variables and stash_vars 
     # these are input_vars for calculation defined in already in mapping db
     vars_list, no_ver, no_frq, no_match, stash_vars = parse_vars(conn, 
-        rows, version, db_log)
+        rows, version, db_log, mapidx=mapidx)
     # remove duplicates from partially matched variables: no_version, input_only 
     no_ver = remove_duplicate(no_ver)
     no_frq = remove_duplicate(no_frq, strict=False)
     no_match = remove_duplicate(no_match, strict=False)
     # now check if derived variables can be added based on all input_vars being available
-    pot_vars, pot_varnames = potential_vars(conn, rows, stash_vars, db_log)
+    pot_vars, pot_varnames = potential_vars(conn, rows, stash_vars, db_log,
+        mapidx=mapidx)
     pot_vars = remove_duplicate(pot_vars)
     # at the moment we don't distiguish yet between different definitions of the variables (i.e. different frequency etc)
     db_log.info(f"Definable cmip var: {pot_varnames}")
@@ -365,8 +368,10 @@ def update_map(ctx, dbname, fname, alias):
 @click.option('--version', '-v', required=False, default='CM2',
     type=click.Choice(['ESM1.5', 'CM2', 'AUS2200', 'OM2']), show_default=True,
     help='ACCESS version currently only CM2, ESM1.5, AUS2200, OM2')
+@click.option('--ncpus', '-n', type=int, required=False, default=4,
+    show_default=True, help='Number of processes used to read files')
 @click.pass_context
-def model_vars(ctx, indir, startdate, dbname, version):
+def model_vars(ctx, indir, startdate, dbname, version, ncpus):
     """Read variables from model output
        opens one file for each kind, save variable list as csv file
        alias is not used so far
@@ -383,6 +388,8 @@ def model_vars(ctx, indir, startdate, dbname, version):
         Database name (default is data/access.db)
     version : str
         Version of ACCESS model to use as preferred mapping
+    ncpus : int
+        Number of processes used to read files (default 4)
 
     Returns
     -------
@@ -390,5 +397,5 @@ def model_vars(ctx, indir, startdate, dbname, version):
     db_log = ctx.obj['log']
     # connect to db, this will create one if not existing
     conn = db_connect(dbname, db_log)
-    write_varlist(conn, indir, startdate, version, db_log)
+    write_varlist(conn, indir, startdate, version, db_log, ncpus=ncpus)
     return
@@ -26,10 +26,12 @@ import sys
 import os
 import csv
 import glob
+import fnmatch
 import json
 import stat
 import xarray as xr
 import math
+import concurrent.futures
 from datetime import datetime, date
 from collections import Counter
 
@@ -267,6 +269,70 @@ def get_cmorname(conn, varname, version, frequency, db_log):
         WHERE input_vars='{varname}' and (calculation=''
         or calculation IS NULL)""" 
     results = query(conn, sql, first=False)
+    return match_cmorname(results, varname, version, frequency, db_log)
+
+
+class MappingIndex():
+    """In-memory index of the mapping table, built once from the
+    database so variables are matched with dictionary lookups instead
+    of a query for each variable.
+
+    Attributes
+    ----------
+    by_var : dict
+        {input_vars: [(cmor_var, model, cmor_table, frequency), ...]}
+        for records with no calculation, as returned by get_cmorname query
+    by_id : dict
+        {(input_vars, frequency, model): (cmor_var, positive, units)}
+        for records with no calculation
+    by_frq : dict
+        {(input_vars, frequency): (cmor_var, positive, units)}
+    by_version : dict
+        {(input_vars, model): (cmor_var, positive, units)}
+    by_input : dict
+        {input var: [mapping record, ...]} for records with a calculation,
+        indexed by each of their input variables
+    """
+
+    def __init__(self, conn):
+        self.by_var = {}
+        self.by_id = {}
+        self.by_frq = {}
+        self.by_version = {}
+        self.by_input = {}
+        results = query(conn, "SELECT * FROM mapping", first=False)
+        for r in results:
+            cmor_var, input_vars, calculation = r[:3]
+            frequency, positive, model = r[5], r[8], r[10]
+            if calculation in ['', None]:
+                self.by_var.setdefault(input_vars, []).append(
+                    (cmor_var, model, r[9], frequency))
+            if calculation == '':
+                match = (cmor_var, positive, r[3])
+                self.by_id[(input_vars, frequency, model)] = match
+                self.by_frq.setdefault((input_vars, frequency), match)
+                self.by_version.setdefault((input_vars, model), match)
+            else:
+                for v in set(input_vars.split(" ")):
+                    self.by_input.setdefault(v, []).append(r)
+
+    def cmorname(self, varname, version, frequency, db_log):
+        """Returns cmip name and table for variable, as get_cmorname
+        """
+        return match_cmorname(self.by_var.get(varname, []), varname,
+                              version, frequency, db_log)
+
+    def calculations(self, varname):
+        """Returns mapping records of calculations using variable
+        """
+        return self.by_input.get(varname, [])
+
+
+def match_cmorname(results, varname, version, frequency, db_log):
+    """Returns cmip name and table from list of mapping records for
+       variable, if more than one preference is given to records
+       matching both version and frequency, then frequency, then version
+    """
     names = list(x[0] for x in results) 
     tables = list(x[2] for x in results) 
     if len(names) == 0:
@@ -487,86 +553,133 @@ def get_cell_methods(attrs, dims):
     return val, frqmod
 
 
-def write_varlist(conn, indir, startdate, version, db_log):
+def get_realm(fpath):
+    """Returns realm based on directory names in file path"""
+    try:
+        realm = [x for x in ['/atmos/', '/ocean/', '/ice/'] if x in fpath][0]
+    except:
+        realm = [x for x in ['/atm/', '/ocn/', '/ice/'] if x in fpath][0]
+    realm = realm[1:-1]
+    if realm == 'atm':
+        realm = 'atmos'
+    elif realm == 'ocn':
+        realm = 'ocean'
+    return realm
+
+
+def read_header(fpath, realm, db_log):
+    """Reads variables metadata from file, without loading data.
+       Returns frequency, dictionary of frequency by time axis (if more
+       than one) and list of variables attributes
+    """
+    fname = os.path.basename(fpath)
+    with xr.open_dataset(fpath, decode_times=False) as ds:
+        coords = [c for c in ds.coords] + ['latitude_longitude']
+        frequency, umfrq = get_frequency(realm, fname, ds, db_log)
+        variables = []
+        for vname in ds.variables:
+            if vname not in coords and all(x not in vname for x in ['_bnds','_bounds']):
+                v = ds[vname]
+                # get size in bytes of grid for 1 timestep and number of timesteps
+                vsize = v.dtype.itemsize * math.prod(v.shape[1:])
+                variables.append({'name': vname, 'dims': v.dims,
+                    'attrs': dict(v.attrs), 'dtype': v.dtype,
+                    'size': vsize, 'nsteps': v.shape[0]})
+    return frequency, umfrq, variables
+
+
+def write_varlist(conn, indir, startdate, version, db_log, ncpus=4):
     """Based on model output files create a variable list and save it
        to a csv file. Main attributes needed to map output are provided
-       for each variable
+       for each variable.
+       Input directory is listed once, one file for each pattern is
+       opened in parallel, by at most ncpus processes, to read the
+       variables metadata and csv files are written at the end.
     """
     #PP temporarily remove .nc as ocean files sometimes have pattern.nc-datestamp
     #sdate = f"*{startdate}*.nc"
     sdate = f"*{startdate}*"
-    files = list_files(indir, sdate, db_log)
+    allfiles = list_files(indir, "*", db_log)
+    files = [f for f in allfiles if fnmatch.fnmatch(os.path.basename(f), sdate)]
     db_log.debug(f"Found files: {files}")
-    patterns = []
+    # get first file for each pattern and count pattern files
+    patterns = {}
     for fpath in files:
-        # get first two items of filename <exp>_<group>
-        fname = fpath.split("/")[-1]
+        fname = os.path.basename(fpath)
         db_log.debug(f"Filename: {fname}")
         # we rebuild file pattern until up to startdate
-        
         fpattern = fname.split(startdate)[0]
         # adding this in case we have a mix of yyyy/yyyymn date stamps 
         # as then a user would have to pass yyyy only and would get 12 files for some of the patterns
-        if fpattern in patterns:
+        if fpattern not in patterns:
+            patterns[fpattern] = fpath
+    nfiles = Counter()
+    for fpath in allfiles:
+        fname = os.path.basename(fpath)
+        for fpattern in patterns.keys():
+            if fname.startswith(fpattern):
+                nfiles[fpattern] += 1
+    # read variables metadata in parallel
+    headers = {}
+    nproc = max(1, min(ncpus, len(patterns)))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=nproc) as executor:
+        futures = {executor.submit(read_header, fpath, get_realm(fpath),
+                   db_log): fpattern for fpattern, fpath in patterns.items()}
+        for future in concurrent.futures.as_completed(futures):
+            fpattern = futures[future]
+            try:
+                headers[fpattern] = future.result()
+            except Exception as e:
+                db_log.error(f"Cannot read {patterns[fpattern]}: {e}")
+    # mapping table is loaded once to retrieve cmip names
+    mapidx = MappingIndex(conn)
+    varlists = {}
+    for fpattern, fpath in patterns.items():
+        if fpattern not in headers:
             continue
-        patterns.append(fpattern)
-        pattern_list = list_files(indir, f"{fpattern}*", db_log)
-        nfiles = len(pattern_list) 
         db_log.debug(f"File pattern: {fpattern}")
-        fcsv = open(f"{fpattern}.csv", 'w')
-        fwriter = csv.writer(fcsv, delimiter=';')
-        fwriter.writerow(["name", "cmor_var", "units", "dimensions",
-                          "frequency", "realm", "cell_methods", "cmor_table",
-                          "dtype", "size", "nsteps", "file_name", "long_name",
-                          "standard_name"])
-        # get attributes for the file variables
-        try:
-            realm = [x for x in ['/atmos/', '/ocean/', '/ice/'] if x in fpath][0]
-        except:
-            realm = [x for x in ['/atm/', '/ocn/', '/ice/'] if x in fpath][0]
-        realm = realm[1:-1]
-        if realm == 'atm':
-            realm = 'atmos'
-        elif realm == 'ocn':
-            realm = 'ocean'
+        realm = get_realm(fpath)
         db_log.debug(realm)
-        ds = xr.open_dataset(fpath, decode_times=False)
-        coords = [c for c in ds.coords] + ['latitude_longitude']
-        frequency, umfrq = get_frequency(realm, fname, ds, db_log)
+        frequency, umfrq, variables = headers[fpattern]
         db_log.debug(f"Frequency: {frequency}")
         db_log.debug(f"umfrq: {umfrq}")
         multiple_frq = False
         if umfrq != {}:
             multiple_frq = True
         db_log.debug(f"Multiple frq: {multiple_frq}")
-        for vname in ds.variables:
-            if vname not in coords and all(x not in vname for x in ['_bnds','_bounds']):
-                v = ds[vname]
-                db_log.debug(f"Variable: {v.name}")
-                # get size in bytes of grid for 1 timestep and number of timesteps
-                vsize = v[0].nbytes
-                nsteps = nfiles * v.shape[0]
-                # assign specific frequency if more than one is available
-                if multiple_frq:
-                    if 'time' in v.dims[0]:
-                        frequency = umfrq[v.dims[0]]
-                    else:
-                        frequency = 'NA'
-                        db_log.info(f"Could not detect frequency for variable: {v}")
-                attrs = v.attrs
-                cell_methods, frqmod = get_cell_methods(attrs, v.dims)
-                varfrq = frequency + frqmod
-                db_log.debug(f"Frequency x var: {varfrq}")
-                # try to retrieve cmip name
-                cmor_var, cmor_table = get_cmorname(conn, vname,
-                    version, varfrq, db_log)
-                line = [v.name, cmor_var, attrs.get('units', ""),
-                        " ".join(v.dims), varfrq, realm, 
-                        cell_methods, cmor_table, v.dtype, vsize,
-                        nsteps, fpattern, attrs.get('long_name', ""), 
-                        attrs.get('standard_name', "")]
-                fwriter.writerow(line)
-        fcsv.close()
+        lines = []
+        for v in variables:
+            db_log.debug(f"Variable: {v['name']}")
+            nsteps = nfiles[fpattern] * v['nsteps']
+            # assign specific frequency if more than one is available
+            if multiple_frq:
+                if 'time' in v['dims'][0]:
+                    frequency = umfrq[v['dims'][0]]
+                else:
+                    frequency = 'NA'
+                    db_log.info(f"Could not detect frequency for variable: {v['name']}")
+            attrs = v['attrs']
+            cell_methods, frqmod = get_cell_methods(attrs, v['dims'])
+            varfrq = frequency + frqmod
+            db_log.debug(f"Frequency x var: {varfrq}")
+            # try to retrieve cmip name
+            cmor_var, cmor_table = mapidx.cmorname(v['name'], version,
+                varfrq, db_log)
+            line = [v['name'], cmor_var, attrs.get('units', ""),
+                    " ".join(v['dims']), varfrq, realm, 
+                    cell_methods, cmor_table, v['dtype'], v['size'],
+                    nsteps, fpattern, attrs.get('long_name', ""), 
+                    attrs.get('standard_name', "")]
+            lines.append(line)
+        varlists[fpattern] = lines
+    for fpattern, lines in varlists.items():
+        with open(f"{fpattern}.csv", 'w') as fcsv:
+            fwriter = csv.writer(fcsv, delimiter=';')
+            fwriter.writerow(["name", "cmor_var", "units", "dimensions",
+                              "frequency", "realm", "cell_methods", "cmor_table",
+                              "dtype", "size", "nsteps", "file_name", "long_name",
+                              "standard_name"])
+            fwriter.writerows(lines)
         db_log.info(f"Variable list for {fpattern} successfully written")
     return
 
@@ -626,10 +739,11 @@ def read_map(fname, alias):
     return var_list
 
 
-def parse_vars(conn, rows, version, db_log):
+def parse_vars(conn, rows, version, db_log, mapidx=None):
     """Returns records of variables to include in template mapping file,
     a list of all stash variables + frequency available in model output
     and a list of variables already defined in db
+    If mapidx (MappingIndex) is not passed, it is built from conn.
     """
     vars_list = []
     no_ver = []
@@ -638,37 +752,23 @@ def parse_vars(conn, rows, version, db_log):
     stash_vars = []
     # get list of variables already in db
     # eventually we should be strict for the moment we might want to capture as much as possible
-    sql = f"""SELECT cmor_var,input_vars,frequency,realm,model,positive,units
-            FROM mapping where calculation=''"""
-    results = query(conn, sql, first=False)
-    # create a list of dict of {(input_vars, realm): cmip-var} from mapping
-    #map_vars = {(x[1], x[2], x[3], x[4]): x[0] for x in results}
-    map_vars = {(x[1], x[2],  x[4]): (x[0],x[5], x[6]) for x in results}
-    db_log.debug(f"Variables already in db: {map_vars}")
+    if mapidx is None:
+        mapidx = MappingIndex(conn)
+    db_log.debug(f"Variables already in db: {mapidx.by_id}")
     for row in rows:
-        found_match = False
         if row[0][0] == "#" or row[0] == 'name':
             continue
         # build tuple with input_vars, frequency and model version
-        else:
-            varid = (row[0],row[4], version)
-        for x in map_vars.keys():
-            if varid == x:
-                vars_list = add_var(vars_list, row, map_vars[x], db_log)
-                found_match = True
-                break
+        varid = (row[0], row[4], version)
         # if no match, ignore model version first and then frequency 
-        if not found_match:
-            if varid[0:2] == x[0:2]:
-                no_ver = add_var(no_ver, row, map_vars[x], db_log)
-                found_match = True
-                break
-        if not found_match:
-            if (varid[0],)+varid[2:] == (x[0],)+x[2:]:
-                no_frq = add_var(no_frq, row, map_vars[x], db_log)
-                found_match = True
-                break
-        if not found_match:
+        if varid in mapidx.by_id:
+            vars_list = add_var(vars_list, row, mapidx.by_id[varid], db_log)
+        elif varid[0:2] in mapidx.by_frq:
+            no_ver = add_var(no_ver, row, mapidx.by_frq[varid[0:2]], db_log)
+        elif (varid[0], varid[2]) in mapidx.by_version:
+            no_frq = add_var(no_frq, row,
+                mapidx.by_version[(varid[0], varid[2])], db_log)
+        else:
             no_match = add_var(no_match, row, (row[0],'', ''), db_log)
         stash_vars.append(f"{row[0]}-{row[4]}")
     return vars_list, no_ver, no_frq, no_match, stash_vars 
@@ -712,32 +812,38 @@ def remove_duplicate(vlist, strict=True):
     return final
 
 
-def potential_vars(conn, rows, stash_vars, db_log):
+def potential_vars(conn, rows, stash_vars, db_log, mapidx=None):
     """Returns list of variables that can be potentially derived from
     model output.
+    If mapidx (MappingIndex) is not passed, it is built from conn.
 
     NB rows modified by add_row when assigning cmorname and positive values
     """
     pot_vars = set()
     pot_varnames = set()
+    if mapidx is None:
+        mapidx = MappingIndex(conn)
+    stash_vars = set(stash_vars)
+    # file patterns for each variable and frequency
+    fnames = {}
+    for i in rows:
+        if len(i) > 12:
+            fnames.setdefault((i[0], i[4]), set()).add(i[12])
     for row in rows:
-        sql = f'SELECT * FROM mapping WHERE input_vars like "%{row[0]}%"'
-        results = query(conn, sql, first=False)
-        for r in results:
+        for r in mapidx.calculations(row[0]):
             # if we are calculating something and more than one variable is needed
-            if r[2] != '':
-                allinput = r[1].split(" ")
-                if all(f"{x}-{row[4]}" in stash_vars for x in allinput):
-                    # add var type, size, nsteps and filename info
-                    # add all file patterns for input variables if frq same
-                    fnames = set([i[12] for i in rows if i[0] in allinput
-                                  and i[4] == row[4]])
-                    line = list(r) + row[9:12] + [" ".join(fnames)]
-                    # add dimensions, frequency from the file
-                    line[4] = row[3]
-                    line[5] = row[4]
-                    pot_vars.add(tuple(line))
-                    pot_varnames.add(r[0])
+            allinput = r[1].split(" ")
+            if all(f"{x}-{row[4]}" in stash_vars for x in allinput):
+                # add var type, size, nsteps and filename info
+                # add all file patterns for input variables if frq same
+                files = set().union(*[fnames.get((x, row[4]), set())
+                                      for x in allinput])
+                line = list(r) + row[9:12] + [" ".join(files)]
+                # add dimensions, frequency from the file
+                line[4] = row[3]
+                line[5] = row[4]
+                pot_vars.add(tuple(line))
+                pot_varnames.add(r[0])
     return pot_vars, pot_varnames
 
 
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# Copyright 2023 ARC Centre of Excellence for Climate Extremes
+# author: Paola Petrelli <paola.petrelli@utas.edu.au>
+# author: Sam Green <sam.green@unsw.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# This is the ACCESS Model Output Post Processor, derived from the APP4
+# originally written for CMIP5 by Peter Uhe and dapted for CMIP6 by Chloe Mackallah
+# ( https://doi.org/10.5281/zenodo.7703469 )
+#
+#
+# last updated 18/10/2026
+
+'''
+Parser for the calculation strings defined in the mappings.
+
+Each distinct calculation is parsed and compiled only once, names are
+resolved against the functions defined in calculations.py, so that
+no other code can be executed from a mapping.
+'''
+
+import ast
+import inspect
+import functools
+import numpy as np
+from dateutil.relativedelta import relativedelta
+
+from mopper import calculations
+
+
+# Methods which remove the dimension/s they are applied to
+reduce_methods = ['sum', 'mean', 'max', 'min', 'std', 'var', 'median',
+                  'prod', 'any', 'all']
+select_methods = ['isel', 'sel']
+# Other names a calculation can use
+safe_names = {'int': int, 'float': float, 'abs': abs, 'min': min,
+              'max': max, 'np': np}
+# Helpers defined in calculations.py which are not calculations,
+# i.e. they read or write files or manage caches
+helper_names = {'read_yaml', 'read_json', 'json_value', 'ancil_cache_dir',
+    'load_ancil', 'save_ancil', 'read_ancil', 'AncilDataset',
+    'WeightsCache', 'grid_key', 'get_plev', 'interp_weights',
+    'apply_interp_weights', 'vertical_interp', 'bottom_index',
+    'take_bottom', 'tile_weights', 'sum_tiles', 'fixed_interval'}
+
+allowed_nodes = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Call,
+    ast.Name, ast.Attribute, ast.Subscript, ast.Constant, ast.List,
+    ast.Tuple, ast.Slice, ast.keyword, ast.Load, ast.operator,
+    ast.unaryop)
+
+
+@functools.lru_cache(maxsize=None)
+def calc_registry():
+    """Returns dictionary of functions and classes defined in
+    calculations.py, except helper_names, these and safe_names are
+    the only names a calculation can use
+    """
+    registry = dict(safe_names)
+    for name, obj in inspect.getmembers(calculations, callable):
+        if (getattr(obj, '__module__', '') == calculations.__name__
+            and not name.startswith('_') and name not in helper_names):
+            registry[name] = obj
+    return registry
+
+
+class Expression():
+    """Compiled calculation string.
+
+    Attributes
+    ----------
+    text : str
+        Original calculation string
+    inputs : list(int)
+        Indexes of input variables used as var[n]
+    whole_var : bool
+        True if the full list of input variables is passed to a function
+    functions : set(str)
+        Names of calculations functions called
+    reduced_dims : list
+        Dimensions (or axis numbers) removed by reducing or selecting methods
+    """
+
+    def __init__(self, text):
+        self.text = text
+        try:
+            tree = ast.parse(text.strip(), mode='eval')
+        except SyntaxError as e:
+            raise ValueError(f"Invalid calculation {text}: {e.msg}")
+        self.functions = set()
+        self.reduced_dims = []
+        inputs = set()
+        nvar = 0
+        nsub = 0
+        registry = calc_registry()
+        for node in ast.walk(tree):
+            if not isinstance(node, allowed_nodes):
+                raise ValueError(f"Invalid calculation {text}: " +
+                    f"{type(node).__name__} not allowed")
+            if isinstance(node, ast.Name):
+                if node.id == 'var':
+                    nvar += 1
+                elif node.id not in registry:
+                    raise ValueError(f"Invalid calculation {text}: " +
+                        f"{node.id} is not defined in calculations")
+            elif isinstance(node, ast.Subscript):
+                if (isinstance(node.value, ast.Name) and node.value.id == 'var'):
+                    nsub += 1
+                    if isinstance(node.slice, ast.Constant):
+                        inputs.add(node.slice.value)
+            elif isinstance(node, ast.Attribute):
+                if node.attr.startswith('_'):
+                    raise ValueError(f"Invalid calculation {text}: " +
+                        f"access to {node.attr} not allowed")
+            if isinstance(node, ast.Call):
+                self.add_call(node)
+        # var is passed as a whole if not all its occurrences are var[n]
+        self.whole_var = nvar > nsub
+        self.inputs = sorted(inputs)
+        self.code = compile(tree, '<calculation>', 'eval')
+
+    def add_call(self, node):
+        """Records functions called and dimensions reduced by a call
+        """
+        if isinstance(node.func, ast.Name):
+            self.functions.add(node.func.id)
+        elif isinstance(node.func, ast.Attribute):
+            method = node.func.attr
+            if method in reduce_methods:
+                dims = [k.value for k in node.keywords
+                        if k.arg in ['dim', 'axis']]
+                dims.extend(node.args[:1])
+                for d in dims:
+                    self.reduced_dims.extend(const_values(d))
+            elif method in select_methods:
+                # only scalar selections remove a dimension
+                for k in node.keywords:
+                    if isinstance(k.value, ast.Constant):
+                        self.reduced_dims.append(k.arg)
+
+    def __call__(self, var):
+        """Evaluates calculation for list of input variables
+        """
+        return eval(self.code, {'__builtins__': {}, **calc_registry()},
+                    {'var': var})
+
+    def __repr__(self):
+        return f"Expression({self.text!r})"
+
+
+def const_values(node):
+    """Returns constant value/s from an ast node, empty list if
+    value is not a constant
+    """
+    if isinstance(node, ast.Constant):
+        return [node.value]
+    elif isinstance(node, (ast.List, ast.Tuple)):
+        return [x.value for x in node.elts if isinstance(x, ast.Constant)]
+    return []
+
+
+@functools.lru_cache(maxsize=256)
+def compile_calc(text):
+    """Returns compiled Expression for calculation string,
+    each distinct string is parsed only once per process
+    """
+    return Expression(text)
+
+
+@functools.lru_cache(maxsize=64)
+def parse_delta(interval):
+    """Returns relativedelta from interval string as 'months=1'
+    or 'hours=1.5'
+    """
+    kwargs = {}
+    for arg in interval.split(','):
+        k, v = arg.split('=')
+        v = v.strip()
+        kwargs[k.strip()] = float(v) if '.' in v else int(v)
+    return relativedelta(**kwargs)
@@ -32,11 +32,18 @@ more eficiently and optimized inn general; i.e. reduced number of For and If sta
 
 import click
 import xarray as xr
+import pandas as pd
 import os
+import re
+import datetime
 import yaml
 import json 
 import numpy as np
 import dask
+import dask.array
+import threading
+import functools
+from collections import OrderedDict
 
 # Global Variables
 #----------------------------------------------------------------------
@@ -60,6 +67,150 @@ def read_yaml(fname):
     with open(fname, 'r') as yfile:
         data = yaml.safe_load(yfile)
     return data
+
+
+def read_json(fname):
+    """Returns parsed json file, files are parsed once per process
+    and re-read only if modified. The returned dictionary is shared,
+    so it shouldn't be modified.
+    """
+    return _cached_json(fname, os.path.getmtime(fname))
+
+
+@functools.lru_cache(maxsize=32)
+def _cached_json(fname, mtime):
+    with open(fname, 'r') as jfile:
+        data = json.load(jfile)
+    return data
+
+
+# Ancillary files store
+#----------------------------------------------------------------------
+# Ancillary variables already loaded by this process
+ancil_arrays = {}
+
+
+def json_value(v):
+    """Converts numpy values to python types to save attributes as json
+    """
+    return v.tolist() if hasattr(v, 'tolist') else v
+
+
+def ancil_cache_dir():
+    """Returns directory used to share ancillary arrays among workers,
+    ancil_cache in the output path, or None if not running mop
+    """
+    ctx = click.get_current_context(silent=True)
+    if ctx is None or not isinstance(ctx.obj, dict) or 'outpath' not in ctx.obj:
+        return None
+    return f"{ctx.obj['outpath']}/ancil_cache"
+
+
+def load_ancil(fname, varname, base='', cache_dir=None):
+    """Returns a variable from an ancillary file.
+    If cache_dir is passed, the variable is returned as a read-only
+    DataArray backed by memory-mapped .npy files. The first time a
+    variable is used in a job, it is saved with its coordinates in
+    cache_dir, then all workers map the same files, so only one copy is
+    held in memory and the netcdf file is decoded only once.
+    Otherwise the variable is read from the file and kept in memory.
+
+    Parameters
+    ----------
+    fname : str
+        Ancillary file name, relative to base or absolute
+    varname : str
+        Name of variable to load
+    base : str
+        Path of ancillary files (default '', fname is used as it is)
+    cache_dir : str
+        Directory for memory-mapped arrays (default None)
+
+    Returns
+    -------
+    var : Xarray DataArray
+        Ancillary variable
+    """
+    fname = os.path.join(base, fname)
+    key = (fname, varname)
+    if key not in ancil_arrays:
+        if cache_dir is None:
+            with xr.open_dataset(fname) as ds:
+                ancil_arrays[key] = ds[varname].load()
+        else:
+            stem = (f"{cache_dir}/{os.path.basename(fname)}.{varname}."
+                    + f"{int(os.path.getmtime(fname))}")
+            if not os.path.exists(f"{stem}.json"):
+                save_ancil(fname, varname, stem)
+            ancil_arrays[key] = read_ancil(stem)
+    return ancil_arrays[key]
+
+
+def save_ancil(fname, varname, stem):
+    """Saves ancillary variable and coordinates as .npy files, metadata
+    are saved last in json file. Files are written to a temporary file
+    and then renamed, so workers never read incomplete files.
+    """
+    os.makedirs(os.path.dirname(stem), exist_ok=True)
+    with xr.open_dataset(fname) as ds:
+        var = ds[varname].load()
+    meta = {'name': var.name, 'dims': list(var.dims),
+            'attrs': {k: json_value(v) for k,v in var.attrs.items()},
+            'coords': {}}
+    arrays = {'data': var.values}
+    for c in var.coords:
+        arrays[c] = var[c].values
+        meta['coords'][c] = {'dims': list(var[c].dims),
+            'attrs': {k: json_value(v) for k,v in var[c].attrs.items()}}
+    for k,a in arrays.items():
+        tmp = f"{stem}.{k}.{os.getpid()}.npy"
+        np.save(tmp, a, allow_pickle=(a.dtype == object))
+        os.replace(tmp, f"{stem}.{k}.npy")
+    tmp = f"{stem}.{os.getpid()}.json"
+    with open(tmp, 'w') as jfile:
+        json.dump(meta, jfile)
+    os.replace(tmp, f"{stem}.json")
+    return
+
+
+def read_ancil(stem):
+    """Returns DataArray from files saved by save_ancil, arrays are
+    memory-mapped read-only, except object arrays (i.e. cftime dates)
+    """
+    with open(f"{stem}.json", 'r') as jfile:
+        meta = json.load(jfile)
+
+    def load(k):
+        try:
+            return np.load(f"{stem}.{k}.npy", mmap_mode='r')
+        except ValueError:
+            return np.load(f"{stem}.{k}.npy", allow_pickle=True)
+
+    coords = {c: (v['dims'], load(c), v['attrs'])
+              for c,v in meta['coords'].items()}
+    return xr.DataArray(load('data'), dims=meta['dims'], coords=coords,
+                        name=meta['name'], attrs=meta['attrs'])
+
+
+class AncilDataset():
+    """Ancillary file with variables loaded by load_ancil
+    when accessed as ds[varname] or ds.varname
+    """
+
+    def __init__(self, fname, cache_dir=None):
+        self.fname = fname
+        self.cache_dir = cache_dir
+
+    def __getitem__(self, varname):
+        return load_ancil(self.fname, varname, cache_dir=self.cache_dir)
+
+    def __getattr__(self, varname):
+        if varname.startswith('_'):
+            raise AttributeError(varname)
+        return self[varname]
+
+    def close(self):
+        return
 #----------------------------------------------------------------------
 
 
@@ -73,6 +224,9 @@ def time_resample(var, trange, tdim, sample='down', stats='mean'):
     closed = 'right'
     This put the time label to the start of the interval and offset is applied
     to get a centered time label.
+    When downsampling a regular time series to a fixed length interval
+    which is a multiple of its timestep, block_resample is used,
+    otherwise xarray resample.
 
     Parameters
     ----------
@@ -98,6 +252,8 @@ def time_resample(var, trange, tdim, sample='down', stats='mean'):
         If the input variable is not a valid Xarray object.
     ValueError
         If the sample parameter is not 'up' or 'down'.
+    ValueError
+        If the resample fails.
     """
 
     if not isinstance(var, (xr.DataArray, xr.Dataset)):
@@ -113,6 +269,9 @@ def time_resample(var, trange, tdim, sample='down', stats='mean'):
               'M': [15, 'D'], 'Y': [6, 'M'], '10Y': [5, 'Y']}
 
     if sample == 'down':
+        vout = block_resample(var, trange, tdim, stats)
+        if vout is not None:
+            return vout
         try:
             vout = var.resample({tdim: trange}, origin='start_day',
                                 closed='right')
@@ -120,21 +279,103 @@ def time_resample(var, trange, tdim, sample='down', stats='mean'):
             vout = method()
             half, tunit = offset[trange][:]
             vout = vout.assign_coords({tdim: xr.CFTimeIndex(vout[tdim].values).shift(half, tunit)})
-    
         except Exception as e:
-            print(f'{e}')
+            raise ValueError(f"Resample of {tdim} to {trange} failed: {e}")
 
     elif sample == 'up':
         try:
             vout = var.resample({tdim: trange}).interpolate("linear")
-    
         except Exception as e:
-            print(f'{e}')
+            raise ValueError(f"Resample of {tdim} to {trange} failed: {e}")
 
     else:
         raise Exception('sample is expected to be up or down')
 
     return vout
+
+
+def fixed_interval(trange):
+    """Returns interval as timedelta, if trange is a fixed length
+    frequency as '30m', '3H' or '10D', None otherwise (i.e. months)
+    """
+    units = {'m': 'minutes', 'T': 'minutes', 'min': 'minutes',
+             'H': 'hours', 'h': 'hours', 'D': 'days'}
+    match = re.fullmatch(r'(\d*)(min|m|T|H|h|D)', trange)
+    if match is None:
+        return None
+    n = int(match.group(1) or 1)
+    return datetime.timedelta(**{units[match.group(2)]: n})
+
+
+def block_resample(var, trange, tdim, stats='mean'):
+    """Downsamples a regular time series reshaping the time axis into
+    (n_out, k) blocks and reducing along k, where k is the number of
+    input timesteps in each interval. Time chunks are aligned with
+    output intervals, so each block is reduced independently.
+    Intervals are defined as in time_resample (origin at the start of
+    first day, closed on the right) and incomplete intervals at the
+    start or end are padded with NaN.
+
+    Returns None if this is not possible: irregular timesteps,
+    interval not a multiple of timestep or of variable length
+    (i.e. months), non float variable.
+
+    Parameters
+    ----------
+    var : xarray.DataArray
+        Variable to resample
+    trange : str
+        Output frequency
+    tdim : str
+        Name of time dimension
+    stats : str
+        Reducing function: mean, min, max, sum (default mean)
+
+    Returns
+    -------
+    vout : xarray.DataArray or None
+        Resampled variable, with time at the centre of the interval
+    """
+    interval = fixed_interval(trange)
+    if (interval is None or not isinstance(var, xr.DataArray)
+        or var.dtype.kind != 'f' or var.sizes.get(tdim, 0) < 2):
+        return None
+    times = var[tdim].values
+    steps = np.diff(times)
+    dt = steps[0]
+    if not isinstance(dt, datetime.timedelta):
+        dt = pd.Timedelta(dt).to_pytimedelta()
+        steps = [pd.Timedelta(x) for x in steps]
+    if dt <= datetime.timedelta(0) or interval % dt or any(x != dt for x in steps):
+        return None
+    t0 = times[0]
+    if not hasattr(t0, 'replace'):
+        t0 = pd.Timestamp(t0).to_pydatetime()
+    origin = t0.replace(hour=0, minute=0, second=0, microsecond=0)
+    if (t0 - origin) % dt:
+        return None
+    k = interval // dt
+    # position of first timestep (in timesteps from origin), intervals
+    # are closed on the right, so step s belongs to interval (s-1)//k
+    s0 = (t0 - origin) // dt
+    first = (s0 - 1) // k
+    before = (s0 - 1) % k
+    after = -(before + len(times)) % k
+    nout = (before + len(times) + after) // k
+    # drop time coordinates, replaced by interval centres
+    vout = var.drop_vars([c for c in var.coords if tdim in var[c].dims])
+    if before or after:
+        vout = vout.pad({tdim: (before, after)})
+    if vout.chunks is not None:
+        tchunk = max(vout.chunks[vout.dims.index(tdim)])
+        vout = vout.chunk({tdim: k * max(1, round(tchunk / k))})
+    vout = getattr(vout.coarsen({tdim: k}), stats)()
+    centres = [origin + (first + n) * interval + interval / 2
+               for n in range(nout)]
+    vout = vout.assign_coords({tdim: centres})
+    vout[tdim].attrs = var[tdim].attrs
+    vout[tdim].encoding = var[tdim].encoding
+    return vout
 #----------------------------------------------------------------------
 
 
@@ -156,9 +397,11 @@ class IceTransportCalculations():
     def __init__(self, ancillary_path):
         self.yaml_data = read_yaml('data/transport_lines.yaml')['lines']
 
-        self.gridfile = xr.open_dataset(f"{ancillary_path}/{self.yaml_data['gridfile']}")
+        self.gridfile = AncilDataset(f"{ancillary_path}/{self.yaml_data['gridfile']}",
+            cache_dir=ancil_cache_dir())
         self.lines = self.yaml_data['sea_lines']
         self.ice_lines = self.yaml_data['ice_lines']
+        self.operators = {}
 
     def __del__(self):
         self.gridfile.close()
@@ -190,56 +433,57 @@ class IceTransportCalculations():
         return L
     
 
-    def transAcrossLine(self, var, i_start, i_end, j_start, j_end):
+    def line_operator(self, lines):
         """
-        Calculate the mass trasport across a line either i_start=i_end and 
-        the line goes from j_start to j_end or j_start=j_end and the line goes 
-        from i_start to i_end var is either the x or y mass transport depending 
-        on the line
+        Returns selection and weight operator for a list of lines,
+        built from the segments defined in data/transport_lines.yaml.
+        Segments are grouped by component and line options, for each
+        group the (j, i) indexes of the grid points crossed by the
+        lines and a (npoints x nlines) weight matrix are returned.
 
 
         Parameters
         ----------
-        var : array
-            variable extracted from Xarray dataset
-        i_start: int
-            xt_ocean axis position
-        i_end: int
-            xt_ocean axis position
-        j_start: int
-            yu_ocean axis position
-        j_end: int
-            yu_ocean axis position
+        lines : tuple(str)
+            names of lines
 
 
         Returns
         -------
-        transports : array
+        ops : dict
+            {(xy, levels, positive): (j, i, weights)}
 
         """
-        if 'yt_ocean' in var:
-            y_ocean = 'yt_ocean'
-            x_ocean = 'xu_ocean'
-        else:
-            y_ocean = 'yu_ocean'
-            x_ocean = 'xt_ocean'
-
-        if i_start==i_end or j_start==j_end:
-            try:
-                #sum each axis apart from time (3d)
-                #trans = var.isel(yu_ocean=slice(271, 271+1), xt_ocean=slice(292, 300+1))
-                trans = var[..., j_start:j_end+1, i_start:i_end+1].sum(dim=['st_ocean', f'{y_ocean}', f'{x_ocean}']) #4D
-            except:
-                trans = var[..., j_start:j_end+1, i_start:i_end+1].sum(dim=[f'{y_ocean}', f'{x_ocean}']) #3D
-            
-            return trans
-        else: 
-            raise Exception('ERROR: Transport across a line needs to be calculated for a single value of i or j')
-
-
-    def lineTransports(self, tx_trans, ty_trans):
+        if lines in self.operators:
+            return self.operators[lines]
+        points = {}
+        for n,line in enumerate(lines):
+            opts = self.yaml_data['line_options'].get(line, {})
+            for xy, i_start, i_end, j_start, j_end in self.yaml_data['segments'][line]:
+                if i_start != i_end and j_start != j_end:
+                    raise Exception('ERROR: Transport across a line needs to be calculated for a single value of i or j')
+                key = (xy, opts.get('levels', None), opts.get('positive', False))
+                jj, ii = np.meshgrid(np.arange(j_start, j_end+1),
+                    np.arange(i_start, i_end+1), indexing='ij')
+                points.setdefault(key, []).extend(
+                    (j, i, n) for j,i in zip(jj.ravel(), ii.ravel()))
+        ops = {}
+        for key, pts in points.items():
+            pts = np.array(pts)
+            ji, inv = np.unique(pts[:,:2], axis=0, return_inverse=True)
+            weights = np.zeros((len(ji), len(lines)))
+            np.add.at(weights, (inv.ravel(), pts[:,2]), 1)
+            ops[key] = (ji[:,0], ji[:,1], weights)
+        self.operators[lines] = ops
+        return ops
+
+
+    def sum_lines(self, tx_trans, ty_trans, lines, dim):
         """
-        Calculates the mass transports across the ocn straits.
+        Calculates the transports across a list of lines, all lines and
+        timesteps are computed with one lazy reduction: the grid points
+        crossed by the lines are selected once for each component and
+        multiplied by a weight matrix.
 
 
         Parameters
@@ -248,77 +492,59 @@ class IceTransportCalculations():
             variable extracted from Xarray dataset
         ty_trans: array
             variable extracted from Xarray dataset
+        lines : list(str)
+            names of lines
+        dim : str
+            name of line dimension, oline or siline
 
 
         Returns
         -------
-        trans : array
+        transports : Xarray DataArray
+            transports with dimensions (time, dim)
 
         """
-        #initialise array
-        transports = np.zeros([len(tx_trans.time),len(self.lines)])
-        
-        #0 barents opening
-        transports[:,0] = self.transAcrossLine(ty_trans,292,300,271,271)
-        transports[:,0] += self.transAcrossLine(tx_trans,300,300,260,271)
+        operator = self.line_operator(tuple(lines))
+        if len(operator) == 0:
+            raise ValueError(f"No segments defined for lines: {lines}")
+        transports = 0
+        for (xy, levels, positive), (j, i, w) in operator.items():
+            var = tx_trans if xy == 'x' else ty_trans
+            if levels is not None:
+                var = var.isel({var.dims[-3]: slice(0, levels)})
+            if positive:
+                var = var.where(var >= 0)
+            ydim, xdim = var.dims[-2:]
+            pts = var.isel({ydim: xr.DataArray(j, dims='point'),
+                            xdim: xr.DataArray(i, dims='point')}, drop=True)
+            #sum each axis apart from time
+            pts = pts.fillna(0).sum(dim=[d for d in pts.dims
+                if d not in [var.dims[0], 'point']])
+            weights = xr.DataArray(w, dims=['point', dim])
+            transports = transports + xr.dot(pts, weights, dim='point')
+        return transports.assign_coords({dim: lines})
 
-        #1 bering strait
-        transports[:,1] = self.transAcrossLine(ty_trans,110,111,246,246)
 
-        #2 canadian archipelago
-        transports[:,2] = self.transAcrossLine(ty_trans,206,212,285,285)
-        transports[:,2] += self.transAcrossLine(tx_trans,235,235,287,288)
+    def lineTransports(self, tx_trans, ty_trans):
+        """
+        Calculates the mass transports across the ocn straits.
 
-        #3 denmark strait
-        transports[:,3] = self.transAcrossLine(tx_trans,249,249,248,251)
-        transports[:,3] += self.transAcrossLine(ty_trans,250,255,247,247)
 
-        #4 drake passage
-        transports[:,4] = self.transAcrossLine(tx_trans,212,212,32,49)
+        Parameters
+        ----------
+        tx_trans : array
+            variable extracted from Xarray dataset
+        ty_trans: array
+            variable extracted from Xarray dataset
 
-        #5 english channel 
-        # Is unresolved by the access model
 
-        #6 pacific equatorial undercurrent
-        #specified down to 350m not the whole depth
-        tx_trans_ma = tx_trans.where(tx_trans[:, 0:25, :] >= 0)
-        transports[:,6] = self.transAcrossLine(tx_trans_ma,124,124,128,145)
-        
-        #7 faroe scotland channel    
-        transports[:,7] = self.transAcrossLine(ty_trans,273,274,238,238)
-        transports[:,7] += self.transAcrossLine(tx_trans,274,274,232,238)
-
-        #8 florida bahamas strait
-        transports[:,8] = self.transAcrossLine(ty_trans,200,205,192,192)
-
-        #9 fram strait
-        transports[:,9] = self.transAcrossLine(tx_trans,267,267,279,279)
-        transports[:,9] += self.transAcrossLine(ty_trans,268,284,278,278)
-
-        #10 iceland faroe channel
-        transports[:,10] = self.transAcrossLine(ty_trans,266,268,243,243)
-        transports[:,10] += self.transAcrossLine(tx_trans,268,268,240,243)
-        transports[:,10] += self.transAcrossLine(ty_trans,269,272,239,239)
-        transports[:,10] += self.transAcrossLine(tx_trans,272,272,239,239)
-
-        #11 indonesian throughflow
-        transports[:,11] = self.transAcrossLine(tx_trans,31,31,117,127)
-        transports[:,11] += self.transAcrossLine(ty_trans,35,36,110,110)
-        transports[:,11] += self.transAcrossLine(ty_trans,43,44,110,110)
-        transports[:,11] += self.transAcrossLine(tx_trans,46,46,111,112)
-        transports[:,11] += self.transAcrossLine(ty_trans,47,57,113,113)
-
-        #12 mozambique channel    
-        transports[:,12] = self.transAcrossLine(ty_trans,320,323,91,91)
-
-        #13 taiwan luzon straits
-        transports[:,13] = self.transAcrossLine(ty_trans,38,39,190,190)
-        transports[:,13] += self.transAcrossLine(tx_trans,40,40,184,188)
-
-        #14 windward passage
-        transports[:,14] = self.transAcrossLine(ty_trans,205,206,185,185)
-        
-        return transports
+        Returns
+        -------
+        trans : Xarray DataArray
+            transports with dimensions (time, oline)
+
+        """
+        return self.sum_lines(tx_trans, ty_trans, self.lines, 'oline')
     
     def iceTransport(self, ice_thickness, vel, xy):
         """
@@ -340,7 +566,7 @@ class IceTransportCalculations():
         ice_mass : array
 
         """
-        L = self.gridfile(xy)
+        L = self.get_grid_cell_length(xy)
         ice_mass = ice_density * ice_thickness * vel * L
 
         return ice_mass
@@ -365,7 +591,7 @@ class IceTransportCalculations():
         snow_mass : array
 
         """
-        L = self.gridfile(xy)
+        L = self.get_grid_cell_length(xy)
         snow_mass = snow_density * snow_thickness * vel * L
 
         return snow_mass
@@ -390,7 +616,7 @@ class IceTransportCalculations():
         ice_area : array
 
         """
-        L = self.gridfile(xy)
+        L = self.get_grid_cell_length(xy)
         ice_area = ice_fraction * vel * L
 
         return ice_area
@@ -410,27 +636,11 @@ class IceTransportCalculations():
 
         Returns
         -------
-        transports : array
+        transports : Xarray DataArray
+            transports with dimensions (time, siline)
 
         """
-        transports = np.zeros([len(tx_trans.time),len(self.lines)])
-
-        #0 fram strait
-        transports[:,0] = self.transAcrossLine(tx_trans,267,267,279,279)
-        transports[:,0] += self.transAcrossLine(ty_trans,268,284,278,278)
-
-        #1 canadian archipelago
-        transports[:,1] = self.transAcrossLine(ty_trans,206,212,285,285)
-        transports[:,1] += self.transAcrossLine(tx_trans,235,235,287,288)
-
-        #2 barents opening
-        transports[:,2] = self.transAcrossLine(ty_trans,292,300,271,271)
-        transports[:,2] += self.transAcrossLine(tx_trans,300,300,260,271)
-
-        #3 bering strait
-        transports[:,3] = self.transAcrossLine(ty_trans,110,111,246,246)
-
-        return transports
+        return self.sum_lines(tx_trans, ty_trans, self.ice_lines, 'siline')
     
 
     def icelineTransports(self, ice_thickness, velx, vely):
@@ -533,11 +743,10 @@ class IceTransportCalculations():
         psiu : array
 
         """
-        drake_trans=self.transAcrossLine(tx_trans,212,212,32,49)
-        #loop over times
-        for i,trans in enumerate(drake_trans):
-            #offset psiu by the drake passage transport at that time
-            psiu[i,:] = psiu[i,:]+trans
+        drake_trans = self.sum_lines(tx_trans, tx_trans, ['drake_passage'],
+            'oline').isel(oline=0, drop=True)
+        #offset psiu by the drake passage transport at each time
+        psiu = psiu + drake_trans
         return psiu
 
 
@@ -557,7 +766,8 @@ class SeaIceCalculations():
     def __init__(self, ancillary_path):
         self.yaml_data = read_yaml('data/transport_lines.yaml')['lines']
 
-        self.gridfile = xr.open_dataset(f"{ancillary_path}/{self.yaml_data['gridfile']}")
+        self.gridfile = AncilDataset(f"{ancillary_path}/{self.yaml_data['gridfile']}",
+            cache_dir=ancil_cache_dir())
         self.lines = self.yaml_data['sea_lines']
         self.ice_lines = self.yaml_data['ice_lines']
 
@@ -566,6 +776,13 @@ class SeaIceCalculations():
 
 
 class HemiSeaIce:    
+    """Hemispheric sea ice area, volume and extent.
+
+    Hemisphere masks are built once per grid, from tarea and lat, kept
+    in grid_cache and applied as weights, so both hemispheres and all timesteps are
+    calculated with one lazy weighted sum.
+    """
+
     def __init__(self, var, tarea, lat):
         """Assign var, tarea, and lat to instance variables for later use.
 
@@ -574,76 +791,141 @@ class HemiSeaIce:
         var : Xarray dataset
             seaice variable
         tarea : Xarray dataset
-            _description_
+            grid cell area
         lat : Xarray dataset
-            _description_
+            grid cell latitude
         """     
-        self.var = xr.where(var[0].mask, 0, var[0])
+        self.var = var.fillna(0)
         self.tarea = tarea
         self.lat = lat
+        self.weights = self.hemi_weights(tarea, lat)
     
-    def hemi_calc(self, hemi, var, nhlat, shlat):
-        """Calculate hemisphere seaice fraction.
+    @classmethod
+    def hemi_weights(cls, tarea, lat):
+        """Returns cell areas masked for each hemisphere, with a
+        region dimension, built only once for each grid.
 
         Parameters
         ----------
-        hemi : str
-            hemisphere to calculate seaice fraction for
+        tarea : Xarray dataset
+            grid cell area
+        lat : Xarray dataset
+            grid cell latitude
 
         Returns
         -------
-        vout : Xarray dataset
-            
+        weights : Xarray DataArray
+            area of cells in each hemisphere, 0 elsewhere
         """
+        key = ('hemi', grid_key('tarea', tarea),
+               grid_key('lat', lat, values=True))
+        cached = grid_cache.get(key)
+        if cached is None:
+            area = tarea.fillna(0)
+            weights = xr.concat([area.where(lat >= 0., 0),
+                area.where(lat < 0., 0)], dim='region')
+            weights['region'] = ['north', 'south']
+            cached = (weights.load(),)
+            grid_cache.put(key, cached)
+        return cached[0]
+
+    def hemi_calc(self, var, hemi=None):
+        """Calculate sum of var weighted by hemisphere area.
 
-        if hemi.find('north') != -1:
-            v = var.where(nhlat, drop=True)
-        elif hemi.find('south') != -1:
-            v = var.where(shlat, drop=True)
-        vout = v.sum()
+        Parameters
+        ----------
+        var : Xarray dataset
+            seaice variable
+        hemi : str, optional
+            hemisphere to return, by default both
 
+        Returns
+        -------
+        vout : Xarray dataset
+            time series with region dimension, if hemi is None
+        """
+        vout = xr.dot(var, self.weights, dim=list(self.lat.dims))
+        if hemi is not None:
+            region = 'north' if hemi.find('north') != -1 else 'south'
+            vout = vout.sel(region=region, drop=True)
         return vout
         
-    def calc_hemi_seaice_area_vol(self, hemi):
+    def calc_hemi_seaice_area_vol(self, hemi=None):
         """Calculate the hemi seaice area volume.
 
         Parameters
         ----------
-        hemi : str
+        hemi : str, optional
             Assigning the hemisphere to calculate, either 'north' or'south'.
+            By default both hemispheres
 
         Returns
         -------
-        vout : float
+        vout : Xarray dataset
             seaice area volume
         """        
-        nhlati = self.lat.where(self.lat >= 0., drop=True)
-        shlati = self.lat.where(self.lat < 0., drop=True)
-        var = self.var * self.tarea
+        return self.hemi_calc(self.var, hemi)
 
-        vout = self.hemi_calc(hemi, var, nhlati, shlati)
-
-        return vout.item()
-
-    def calc_hemi_seaice_extent(self, hemi):
+    def calc_hemi_seaice_extent(self, hemi=None):
         """Calculate the hemi seaice extents.
 
         Parameters
         ----------
-        hemi : str
+        hemi : str, optional
             Assigning the hemisphere to calculate, either 'north' or'south'.
+            By default both hemispheres
 
         Returns
         -------
-        vout : float
+        vout : Xarray dataset
             seaice extents
         """
-        nhlatiext = self.lat.where((self.var >= 0.15) & (self.var <= 1.) & (self.lat >= 0.), drop=True)
-        shlatiext = self.lat.where((self.var >= 0.15) & (self.var <= 1.) & (self.lat < 0.), drop=True)
+        ice = ((self.var >= 0.15) & (self.var <= 1.)).astype(np.float32)
+        return self.hemi_calc(ice, hemi)
+
+
+def calc_hemi_seaice_area_vol(var, tarea, lat, hemi=None):
+    """Calculate the hemi seaice area or volume.
+
+    Parameters
+    ----------
+    var : Xarray dataset
+        seaice fraction or thickness
+    tarea : Xarray dataset
+        grid cell area
+    lat : Xarray dataset
+        grid cell latitude
+    hemi : str, optional
+        Either 'north' or 'south', by default both
 
-        vout = self.hemi_calc(hemi, self.tarea, nhlatiext, shlatiext)
+    Returns
+    -------
+    vout : Xarray dataset
+        seaice area or volume
+    """
+    return HemiSeaIce(var, tarea, lat).calc_hemi_seaice_area_vol(hemi)
+
+
+def calc_hemi_seaice_extent(var, tarea, lat, hemi=None):
+    """Calculate the hemi seaice extent.
+
+    Parameters
+    ----------
+    var : Xarray dataset
+        seaice fraction
+    tarea : Xarray dataset
+        grid cell area
+    lat : Xarray dataset
+        grid cell latitude
+    hemi : str, optional
+        Either 'north' or 'south', by default both
 
-        return vout.item()
+    Returns
+    -------
+    vout : Xarray dataset
+        seaice extent
+    """
+    return HemiSeaIce(var, tarea, lat).calc_hemi_seaice_extent(hemi)
 
 
 def topsoil(var):
@@ -680,24 +962,6 @@ def topsoil_tsl(var):
     return soil_tsl
 
 
-def ocean_floor(var):
-    """Not sure.. 
-
-    Parameters
-    ----------
-    var : Xarray dataset
-        pot_temp variable
-
-    Returns
-    -------
-    vout : Xarray dataset
-        ocean floor temperature?
-    """
-    lv = (~var.isnull()).sum(dim='st_ocean') - 1
-    vout = var.take(lv, dim='st_ocean').squeeze()
-    return vout
-
-
 def maskSeaIce(var, sic):
     """Mask seaice.
 
@@ -780,26 +1044,90 @@ def optical_depth(lbplev, var):
 
     return vout
 
-def ocean_floor(var):
-    """Not sure.. 
+# bottom level index cached by grid
+def bottom_index(var, zdim='st_ocean', kmt=None):
+    """Returns index of bottom ocean level for each column, computed
+    from the first timestep of var, or from kmt (number of ocean
+    levels) if passed, i.e. from an ancillary file.
+    The index computed from var is kept in grid_cache by grid and
+    variable name, as variables on the same grid can have different
+    masks.
+
+    Parameters
+    ----------
+    var : Xarray dataset
+        ocean variable
+    zdim : str
+        name of depth dimension (default st_ocean)
+    kmt : Xarray dataset, optional
+        number of ocean levels for each column
+
+    Returns
+    -------
+    kb : Xarray dataset
+        bottom level index, -1 for land columns
+    """
+    if kmt is not None:
+        return (kmt.fillna(0).astype(int) - 1).load()
+    hdims = [d for d in var.dims if d != zdim][-2:]
+    first = var.isel({d: 0 for d in var.dims
+                      if d != zdim and d not in hdims})
+    key = None
+    if var.name is not None:
+        key = ('kmt', var.name, grid_key(zdim, first))
+        cached = grid_cache.get(key)
+        if cached is not None:
+            return cached[0]
+    kb = (first.notnull().sum(dim=zdim) - 1).load()
+    if key is not None:
+        grid_cache.put(key, (kb,))
+    return kb
+
+
+def take_bottom(block, kb):
+    """Returns values at level kb from numpy block with level as last
+    axis, kb is broadcast against the other axes
+    """
+    idx = np.clip(kb, 0, None)[..., None]
+    idx = np.broadcast_to(idx, block.shape[:-1] + (1,))
+    vout = np.take_along_axis(block, idx, axis=-1)[..., 0]
+    return np.where(kb >= 0, vout, np.nan)
+
+
+def ocean_floor(var, kmt=None):
+    """Returns variable at the ocean floor, i.e. the bottom level of
+    each column. The bottom level index is computed once per grid and
+    values are gathered block by block, so only one block of columns
+    is loaded at a time.
 
     Parameters
     ----------
     var : Xarray dataset
         pot_temp variable
+    kmt : Xarray dataset, optional
+        number of ocean levels for each column, if not passed it is
+        calculated from the first timestep of var
 
     Returns
     -------
     vout : Xarray dataset
-        ocean floor temperature?
+        ocean floor temperature
     """
-    lv = (~var.isnull()).sum(dim='st_ocean') - 1
-    vout = var.take(lv, dim='st_ocean').squeeze()
-    return vout
+    zdim = 'st_ocean'
+    kb = bottom_index(var, zdim, kmt)
+    if var.chunks is not None:
+        var = var.chunk({zdim: -1})
+    vout = xr.apply_ufunc(take_bottom, var, kb, input_core_dims=[[zdim], []],
+        dask='parallelized', output_dtypes=[var.dtype])
+    return vout.transpose(*[d for d in var.dims if d != zdim]).squeeze()
 
 
 def calc_global_ave_ocean(var, rho_dzt, area_t):
-    """Calculate global ocean mass transport.
+    """Calculate global ocean mass weighted average.
+
+    The weighted sum and the sum of weights are calculated in the same
+    graph, so each chunk of var and rho_dzt is read only once. area_t
+    is static and it is loaded once per grid and kept in grid_cache.
 
     Parameters
     ----------
@@ -813,15 +1141,23 @@ def calc_global_ave_ocean(var, rho_dzt, area_t):
     Returns
     -------
     vnew : Xarray dataset
-        global ocean mass transport
+        global ocean mass weighted average
     """
-    mass = rho_dzt * area_t
-    
-    try:
-        vnew = var.weighted(mass).mean(dim=('st_ocean', 'yt_ocean', 'xt_ocean'), skipna=True)
-    except:
-        vnew = var.weighted(mass[:, 0, :, :]).mean(dim=('x', 'y'), skipna=True)
-    
+    key = ('area', grid_key('area_t', area_t))
+    cached = grid_cache.get(key)
+    if cached is None:
+        cached = (area_t.load(),)
+        grid_cache.put(key, cached)
+    mass = rho_dzt * cached[0]
+    # surface variables are weighted by top level mass
+    zdim = rho_dzt.dims[1]
+    if zdim not in var.dims:
+        mass = mass.isel({zdim: 0}, drop=True)
+    dims = list(var.dims[1:])
+    valid = var.notnull()
+    total = (var.fillna(0) * mass).sum(dim=dims)
+    weights = mass.where(valid, 0).sum(dim=dims)
+    vnew = total / weights
     return vnew
 
 
@@ -834,9 +1170,7 @@ def get_plev(ctx, levnum):
     plev : numpy array
     """
     fpath = f"{ctx.obj['tables_path']}/{ctx.obj['_AXIS_ENTRY_FILE']}"
-    with open(fpath, 'r') as jfile:
-        data = json.load(jfile)
-    axis_dict = data['axis_entry']
+    axis_dict = read_json(fpath)['axis_entry']
 
     plev = np.array(axis_dict[f"plev{levnum}"]['requested'])
     plev = plev.astype(float)
@@ -844,18 +1178,227 @@ def get_plev(ctx, levnum):
     return plev
 
 
-def pointwise_interp(var, pres, plev):
+def interp_weights(pres, plev, axis=-1, log=False, mask_below=False):
+    """Returns indexes of levels bracketing each of plev in each column
+    of pres and the linear interpolation weights.
+    As for np.interp, values outside the pressure range of a column
+    are set to the closest level value.
+
+    Parameters
+    ----------
+    pres : numpy array
+        Pressure on levels, can be increasing or decreasing along
+        the level axis
+    plev : numpy array
+        Pressure levels to interpolate to
+    axis : int
+        Level axis of pres (default -1)
+    log : bool
+        If True interpolate linearly in log(pressure) (default False)
+    mask_below : bool
+        If True weights are NaN for levels with pressure greater than
+        the bottom level pressure, i.e. below surface (default False)
+
+    Returns
+    -------
+    weights : tuple
+        Lower and upper level index, shape (plev, columns), upper is
+        None if it is always lower + 1, weight of upper level
     """
+    nlev = pres.shape[axis]
+    # move level first, so each level is a contiguous array of columns
+    p = np.ascontiguousarray(np.moveaxis(pres, axis, 0)).reshape(nlev, -1)
+    x = np.asarray(plev, dtype=float)
+    if log:
+        p = np.log(p)
+        x = np.log(x)
+    # pressure is usually decreasing with level, sort only mixed columns
+    dec = p[0] > p[-1]
+    order = None
+    if dec.all():
+        compare = np.greater
+    else:
+        compare = np.less
+        if dec.any():
+            order = np.argsort(p, axis=0)
+            p = np.take_along_axis(p, order, axis=0)
+    # count levels below each plev, this is the index of the upper level
+    # used to interpolate (as searchsorted on each column)
+    ncol = p.shape[1]
+    xcol = x[:, None]
+    itype = np.uint8 if nlev < 256 else np.int32
+    count = np.zeros((len(x), ncol), dtype=itype)
+    found = np.empty((len(x), ncol), dtype=bool)
+    for k in range(nlev):
+        compare(p[k], xcol, out=found)
+        count += found
+    lo = np.clip(count, 1, nlev - 1) - 1
+    i0 = lo.astype(np.intp) * ncol + np.arange(ncol)
+    i1 = i0 + ncol
+    pflat = p.reshape(-1)
+    p0 = pflat[i0]
+    p1 = pflat[i1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        w = np.where(p1 != p0, (xcol - p0) / (p1 - p0), 0.)
+    np.clip(w, 0., 1., out=w)
+    if mask_below:
+        w[xcol > np.maximum(p[0], p[-1])] = np.nan
+    hi = None
+    if order is not None:
+        # convert to indexes of unsorted levels
+        hi = np.take_along_axis(order, lo + 1, axis=0).astype(itype)
+        lo = np.take_along_axis(order, lo, axis=0).astype(itype)
+    return lo, hi, w.astype(np.float32)
+
+
+def apply_interp_weights(var, weights, axis=-1):
+    """Interpolates var using levels indexes and weights
+    returned by interp_weights.
+
+    Returns
+    -------
+    vint : numpy array
+        Interpolated values, level axis is replaced by plev
     """
-    vint = np.interp(plev, pres, var)
-    return vint
+    lo, hi, w = weights
+    nlev = var.shape[axis]
+    v = np.moveaxis(var, axis, 0)
+    shape = v.shape[1:]
+    v = np.ascontiguousarray(v).reshape(-1)
+    ncol = lo.shape[1]
+    col = np.arange(ncol)
+    i0 = lo.astype(np.intp) * ncol + col
+    if hi is None:
+        i1 = i0 + ncol
+    else:
+        i1 = hi.astype(np.intp) * ncol + col
+    v0 = v[i0]
+    vint = v0 + w * (v[i1] - v0)
+    vint = vint.astype(np.float32).reshape((lo.shape[0],) + shape)
+    return np.moveaxis(vint, 0, axis)
+
+
+def vertical_interp(var, pres, plev, axis=-1, log=False, mask_below=False,
+                    key=None, block_info=None):
+    """Linear interpolation of columns of values from pressure levels
+    to plev, working on whole arrays (i.e. a dask block) at once.
+
+    If key is passed, the weights are stored in weights_cache by
+    pressure field and block location and re-used for other variables
+    on the same pressure field.
+
+    Parameters
+    ----------
+    var : numpy array
+        Values to interpolate
+    pres : numpy array
+        Pressure on same levels as var
+    plev : numpy array
+        Pressure levels to interpolate to
+    axis : int
+        Level axis of var and pres, replaced by plev in output (default -1)
+    log : bool
+        If True interpolate linearly in log(pressure) (default False)
+    mask_below : bool
+        If True set to NaN levels below surface (default False)
+    key : str
+        Identifies pressure field, i.e. token of pressure array (default None)
+    block_info : dict
+        Block location, passed by dask.array.map_blocks (default None)
+
+    Returns
+    -------
+    vint : numpy array
+        Interpolated values
+    """
+    if key is None:
+        weights = interp_weights(pres, plev, axis, log, mask_below)
+    else:
+        loc = None
+        if block_info is not None:
+            loc = tuple(block_info[1]['array-location'])
+        wkey = (key, loc, tuple(plev), axis, log, mask_below)
+        weights = weights_cache.get(wkey)
+        if weights is None:
+            weights = interp_weights(pres, plev, axis, log, mask_below)
+            weights_cache.put(wkey, weights)
+    return apply_interp_weights(var, weights, axis)
+
+
+class WeightsCache():
+    """Cache of arrays, as interpolation weights, values are tuples
+    of arrays and their total size is kept under max_mem (MB).
+    If lru is True the least recently used items are evicted to add
+    new ones. Otherwise new items are not added when the cache is full,
+    so when a variable is computed block by block and its blocks don't
+    all fit, the first blocks are still cached for the next variables,
+    while with lru each block would be evicted before it is needed
+    again. These caches need to be cleared explicitly.
+    Used by the dask threads of a process, so access is locked.
+    """
+
+    def __init__(self, max_mem=1024, lru=True):
+        self.max_mem = max_mem
+        self.lru = lru
+        self.items = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.items.get(key, None)
+            if value is not None:
+                self.items.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        nbytes = sum(x.nbytes for x in value if x is not None)
+        with self.lock:
+            if key in self.items or nbytes > self.max_mem * 1024**2:
+                return
+            if (not self.lru and
+                self.size + nbytes > self.max_mem * 1024**2):
+                return
+            self.items[key] = value
+            self.size += nbytes
+            while self.size > self.max_mem * 1024**2:
+                k, v = self.items.popitem(last=False)
+                self.size -= sum(x.nbytes for x in v if x is not None)
+        return
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.size = 0
+        return
+
+
+# interpolation weights, cleared after each group of rows
+weights_cache = WeightsCache(lru=False)
+# static grid variables (hemisphere masks, cell areas) cached by grid
+grid_cache = WeightsCache(max_mem=256)
+
+
+def grid_key(name, var, values=False):
+    """Returns key identifying the grid of a static variable from its
+    dimensions, shape and coordinate values, so it is the same for
+    the variable read from different files. Time coordinates are
+    ignored. If values is True, the variable values are also used
+    (i.e. for latitude).
+    """
+    coords = [var[c].values for c in sorted(var.coords) if 'time' not in c
+              and all('time' not in d for d in var[c].dims)]
+    if values:
+        coords.append(var.values)
+    return dask.base.tokenize(name, var.dims, var.shape, *coords)
 
 
 @click.pass_context
-def plevinterp(ctx, var, pmod, levnum):
+def plevinterp(ctx, var, pmod, levnum, log=False, mask_below=False):
     """Interpolating var from model levels to pressure levels
 
-    _extended_summary_
+    Interpolation is done on each dask block by vertical_interp,
+    weights are cached by pressure field and re-used for other variables.
 
     Parameters
     ----------
@@ -866,6 +1409,10 @@ def plevinterp(ctx, var, pmod, levnum):
     levnum : int 
         Nunber of the pressure levels to load. NB these need to be
         defined in the '_coordinates.yaml' file as 'plev#'
+    log : bool
+        If True interpolate linearly in log(pressure) (default False)
+    mask_below : bool
+        If True set to missing pressure levels below surface (default False)
 
     Returns
     -------
@@ -900,26 +1447,34 @@ def plevinterp(ctx, var, pmod, levnum):
     if override is True:
         pmod = pmod.reindex_like(var, method='nearest')
     var_log.debug(f"pmod and var coordinates: {pmod.dims}, {var.dims}")
-    interp = xr.apply_ufunc(
-        pointwise_interp,
-        var,
-        pmod,
-        plev,
-        input_core_dims=[ [lev],[lev], ["plev"]],
-        output_core_dims=[ ["plev"] ],
-        exclude_dims=set((lev,)),
-        vectorize=True,
-        dask="parallelized",
-        output_dtypes=['float32'],
-        keep_attrs=True
-    )
+    pmod = pmod.transpose(*var.dims)
+    # weights are cached by pressure field and block location and
+    # re-used by variables interpolated on same pressure and plev
+    weights_cache.max_mem = float(ctx.obj.get('weights_mem', 1024))
+    if var.chunks is not None:
+        key = dask.base.tokenize(pmod.data)
+        # level needs to be in one chunk and pmod blocks to match var
+        var = var.chunk({lev: -1})
+        pmod = pmod.chunk(dict(zip(var.dims, var.chunks)))
+        chunks = list(var.chunks)
+        chunks[1] = (len(plev),)
+        data = dask.array.map_blocks(vertical_interp, var.data,
+            pmod.data, plev=plev, axis=1, log=log, mask_below=mask_below,
+            key=key, chunks=chunks, dtype=np.float32,
+            meta=np.array((), dtype=np.float32))
+    else:
+        data = vertical_interp(var.values, pmod.values, plev, axis=1,
+            log=log, mask_below=mask_below,
+            key=dask.base.tokenize(pmod.values))
+    dims = list(var.dims)
+    dims[1] = 'plev'
+    coords = {k: c for k,c in var.coords.items() if lev not in c.dims}
+    interp = xr.DataArray(data, dims=dims, coords=coords, name=var.name,
+        attrs=var.attrs)
     interp['plev'] = plev
     interp['plev'] = interp['plev'].assign_attrs({'units': "Pa",
         'axis': "Z", 'standard_name': "air_pressure",
         'positive': ""})
-    dims = list(var.dims)
-    dims[1] = 'plev'
-    interp = interp.transpose(*dims)
     return interp
 
 #PP removed plevinterp2 and plev19 and related file press_lev
@@ -1022,19 +1577,53 @@ def landFrac(var, landfrac):
         land fraction array
     """    
 
-    try:
+    if landfrac is not None:
         vout = landfrac
-    except:
+    else:
         if var.lat.shape[0] == 145:
-            f = xr.open_dataset(f'{ancillary_path}esm_landfrac.nc')
+            fname = 'esm_landfrac.nc'
         elif var.lat.shape[0] == 144:
-            f = xr.open_dataset(f'{ancillary_path}cm2_landfrac.nc')
+            fname = 'cm2_landfrac.nc'
         else:
             print('nlat needs to be 145 or 144.')
-        vout = f.fld_s03i395 
+        vout = load_ancil(fname, 'fld_s03i395', base=ancillary_path,
+            cache_dir=ancil_cache_dir())
 
     return vout
 
+def tile_weights(tiles, groups):
+    """Returns (n_tiles x n_groups) weight matrix, to sum tiles in
+    groups with a single dot product along pseudo_level_1
+
+    Parameters
+    ----------
+    tiles : Xarray DataArray
+        pseudo_level_1 coordinate (tile numbers)
+    groups : list(list(int))
+        Tile numbers summed for each group
+
+    Returns
+    -------
+    weights : Xarray DataArray
+        Weights with dimensions (pseudo_level_1, group)
+    """
+    tnum = [int(t) for t in tiles.values]
+    w = np.zeros((len(tnum), len(groups)), dtype=np.float32)
+    for j,group in enumerate(groups):
+        for t in group:
+            w[tnum.index(t), j] = 1
+    return xr.DataArray(w, dims=['pseudo_level_1', 'group'],
+        coords={'pseudo_level_1': tiles})
+
+
+def sum_tiles(var, weights):
+    """Returns sum of tiles for each group of weights in one pass over
+    the tile data, missing tiles are ignored unless all are missing.
+    """
+    vout = xr.dot(var.fillna(0), weights, dim='pseudo_level_1')
+    return vout.where(var.notnull().any(dim='pseudo_level_1'))
+
+
 def tileFracExtract(tileFrac, landfrac, tilenum):
     """Calculations the land fraction of a specific type.
         i.e. crops, grass, wetland, etc.
@@ -1055,49 +1644,44 @@ def tileFracExtract(tileFrac, landfrac, tilenum):
     Exception
         tile number must be an integer or list
     """    
-    
-    vout = xr.zeros_like(tileFrac[:, 0, :, :])
-
     if isinstance(tilenum, int):
-        vout += tileFrac.loc[dict(pseudo_level_1=tilenum)]
-    elif isinstance(tilenum, list):
-        for t in tilenum:
-            vout += tileFrac.loc[dict(pseudo_level_1=tilenum)]
-    else:
+        tilenum = [tilenum]
+    elif not isinstance(tilenum, list):
         raise Exception('E: tile number must be an integer or list')
-    
+    weights = tile_weights(tileFrac.pseudo_level_1, [tilenum])
+    vout = sum_tiles(tileFrac, weights).isel(group=0, drop=True)
     vout = vout * landFrac(vout, landfrac)
 
     return vout
 
 def fracLut(var, landfrac, nwd):    
-    #nwd (non-woody vegetation only) - tiles 6,7,9,11 only
-    vout = xr.zeros_like(var[:, :4, :, :])
-
-    # Define the tile indices based on 'nwd' value
-    if nwd == 0:
-        tile_indices = [1, 2, 3, 4, 5, 6, 7, 11, 14]
-    elif nwd == 1:
-        tile_indices = [6, 7, 11]
-
-    # Iterate over the tile indices and update 'vout'
-    # .loc allows you to modify the original array in-place, based on label and index respectively. So when you use .loc, the changes are applied to the original vout1 DataArray.
-    # The sel() operation doesn't work in-place, it returns a new DataArray that is a subset of the original DataArray.
-    for t in tile_indices:
-        vout.loc[dict(pseudo_level_1=1)] += var.loc[dict(pseudo_level_1=t)]
-
-    # Crop tile 9
-    vout.loc[dict(pseudo_level_1=3)] = var.loc[dict(pseudo_level_1=9)]
-
-    # Update urban tile based on 'nwd'
-    if nwd == 0:
-        vout.loc[dict(pseudo_level_1=4)] = var.loc[dict(pseudo_level_1=15)]
-
-    landfrac = landFrac(vout, landfrac)
-    vout.loc[dict(pseudo_level_1=1)] = vout.loc[dict(pseudo_level_1=1)] * landfrac
-    vout.loc[dict(pseudo_level_1=2)] = vout.loc[dict(pseudo_level_1=2)] * landfrac
-    vout.loc[dict(pseudo_level_1=3)] = vout.loc[dict(pseudo_level_1=3)] * landfrac
-    vout.loc[dict(pseudo_level_1=4)] = vout.loc[dict(pseudo_level_1=4)] * landfrac
+    """Returns fraction of land use types, as listed in
+    data/land_tiles.yaml, all land use types are calculated with
+    one dot product along pseudo_level_1.
+
+    Parameters
+    ----------
+    var : Xarray DataArray
+        Tile fractions
+    landfrac : Xarray DataArray
+        Land fraction
+    nwd : int
+        If 1 use non-woody vegetation tiles only
+
+    Returns
+    -------
+    vout : Xarray DataArray
+        Land use fractions with pseudo_level_1 as land use type
+    """
+    land = read_yaml('data/land_tiles.yaml')['land']
+    lut = land['lut']['nwd' if nwd == 1 else 'all']
+    groups = [lut.get(k, []) for k in land['cmip6']]
+    weights = tile_weights(var.pseudo_level_1, groups)
+    vout = sum_tiles(var, weights)
+    vout = vout.rename(group='pseudo_level_1').assign_coords(
+        pseudo_level_1=np.arange(1, len(groups)+1))
+    vout = vout.transpose(*var.dims)
+    vout = vout * landFrac(vout, landfrac)
 
     return vout
 
@@ -1110,45 +1694,42 @@ def tileFraci317():
     vals : Xarray dataset
         tile_frac variable
     """    
-    f = xr.open_dataset(f'{ancillary_path}cm2_tilefrac.nc')
-    vals = f.fld_s03i317
+    vals = load_ancil('cm2_tilefrac.nc', 'fld_s03i317', base=ancillary_path,
+        cache_dir=ancil_cache_dir())
     return vals
 
 def tileAve(var, tileFrac, landfrac, lfrac=1):
-    """tileAve _summary_
+    """Returns average of a land variable over tiles weighted by
+    tile fractions. The weighted sum is a broadcast operation along
+    pseudo_level_1, so it stays lazy if the inputs are dask arrays.
 
     Parameters
     ----------
-    var : _type_
-        _description_
-    tileFrac : _type_
-        _description_
-    landfrac : _type_
-        _description_
+    var : Xarray DataArray
+        Variable defined on tiles (pseudo_level_1)
+    tileFrac : Xarray DataArray or str
+        Tile fractions, or '317' to use the fractions from the
+        CM2 ancillary file (fld_s03i317)
+    landfrac : Xarray DataArray or float
+        Land fraction
     lfrac : int, optional
-        _description_, by default 1
+        If 1 multiply result by landfrac, by default 1
 
     Returns
     -------
-    vout : Xarray dataset
-        _description_
+    vout : Xarray DataArray
+        Variable averaged over tiles
     """    
-    vout = xr.zeros_like(tileFrac[:, :, :, :])
-    
-    if tileFrac == '317':
-        tileFrac=tileFraci317()
-        #loop over pft tiles and sum
-        for k in var.time.values:
-            for i in var.pseudo_level_1.values:
-                vout.loc[dict(pseudo_level_1=i, time=k)] += var.loc[dict(pseudo_level_1=i, time=k)] * tileFrac.loc[dict(pseudo_level_1=i, time=tileFrac.time.values[0])]
-    else:
-        #loop over pft tiles and sum
-        for i in var.pseudo_level_1.values:
-            vout.loc[dict(pseudo_level_1=i)] += var.loc[dict(pseudo_level_1=i)] * tileFrac.loc[dict(pseudo_level_1=i)]
-            
+    if isinstance(tileFrac, str) and tileFrac == '317':
+        tileFrac = tileFraci317()
+    # time-invariant fractions are broadcast to all timesteps
+    if 'time' in tileFrac.dims and ('time' not in var.dims
+        or tileFrac.sizes['time'] == 1):
+        tileFrac = tileFrac.isel(time=0, drop=True)
+    vout = (var * tileFrac).sum(dim='pseudo_level_1', skipna=True,
+                                min_count=1)
     if lfrac == 1:
         vout = vout * landfrac
-
     return vout
 #----------------------------------------------------------------------
 
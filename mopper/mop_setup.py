@@ -270,8 +270,7 @@ def create_var_map(ctx, table, mappings, activity_id=None,
     table_id = table.split('_')[1]
     mop_log.debug(f"Mappings: {mappings}")
     try:
-        with open(fpath, 'r') as fj:
-             vardict = json.load(fj)
+        vardict = read_json(fpath)
     except JSONDecodeError as e:
         mop_log.error(f"Invalid json {fpath}: {e}")
         raise 
@@ -48,9 +48,18 @@ import logging
 import cftime
 import itertools
 import copy
+import json
+import sqlite3
+import fnmatch
+import functools
+import math
+import dask
+import concurrent.futures
 from functools import partial
 
 from mopper.calculations import *
+from mopper.calc_utils import compile_calc
+from mopdb.mopdb_utils import db_connect
 
 
 def config_log(debug, path):
@@ -113,25 +122,300 @@ def config_varlog(debug, logname):
     return logger
 
 
-def _preselect(ds, varlist):
+def _preselect(ds, varlist, trange=None):
     varsel = [v for v in varlist if v in ds.variables]
     coords = ds[varsel].coords
     bnds = ['bnds', 'bounds', 'edges']
     pot_bnds = [f"{x[0]}_{x[1]}" for x in itertools.product(coords, bnds)]
     varsel.extend( [v for v in ds.variables if v in pot_bnds] )
-    return ds[varsel]
+    ds = ds[varsel]
+    # select time range in each file before files are concatenated
+    if trange is not None:
+        for d in ds.dims:
+            if 'time' not in d or d not in ds.indexes:
+                continue
+            ds = ds.sel({d: slice(*trange)})
+    return ds
+
+
+def open_input(paths, varlist, trange=None, parallel=False, **kwargs):
+    """Opens input files as one dataset, as xarray open_mfdataset,
+    selecting variables and time range on each file (see _preselect)
+    before files are combined. Files with no timesteps in the time
+    range are dropped, if none has data in range the first file is
+    returned with no timesteps.
+
+    Parameters
+    ----------
+    paths : list
+        Input files paths
+    varlist : list
+        Variables to select
+    trange : tuple
+        Start and end of time range (default None, no selection)
+    parallel : bool
+        If True open files in parallel with dask (default False)
+    kwargs : dict
+        Arguments passed to xarray open_dataset
+
+    Returns
+    -------
+    ds : xarray Dataset
+        Combined dataset, closing it closes all files
+    """
+    open_ = partial(xr.open_dataset, **kwargs)
+    preselect = partial(_preselect, varlist=varlist, trange=trange)
+    getattr_ = getattr
+    if parallel:
+        open_ = dask.delayed(open_)
+        preselect = dask.delayed(preselect)
+        getattr_ = dask.delayed(getattr)
+    opened = [open_(p) for p in paths]
+    closers = [getattr_(ds, 'close') for ds in opened]
+    datasets = [preselect(ds) for ds in opened]
+    if parallel:
+        datasets, closers = dask.compute(datasets, closers)
+    keep = [ds for ds in datasets if all(n > 0 for d,n in ds.sizes.items()
+                                         if 'time' in d)]
+    if len(keep) == 0:
+        keep = datasets[:1]
+    if len(keep) == 1:
+        combined = keep[0]
+    else:
+        combined = xr.combine_by_coords(keep, combine_attrs='override')
+    combined.set_close(lambda: [close() for close in closers])
+    return combined
 
 
 
+def time_stamp(t):
+    """Returns date as string YYYYmmddHHMM, works for both datetime
+    and cftime objects
+    """
+    return f"{t.year:04d}{t.month:02d}{t.day:02d}{t.hour:02d}{t.minute:02d}"
+
+
+def scan_file(fpath):
+    """Reads input file metadata to add to fileindex table.
+    Returns variables in file with their time dimension, first and
+    last value of each time dimension and file modification time.
+
+    Returns
+    -------
+    row : tuple
+        filepath, variables and times as json strings and mtime
+    """
+    mtime = os.path.getmtime(fpath)
+    with xr.open_dataset(fpath, decode_times=False) as ds:
+        tdims = [d for d in ds.dims if 'time' in d or
+                 (d in ds.variables and ds[d].attrs.get('axis', '') == 'T')]
+        variables = {}
+        for v in ds.variables:
+            vdims = [d for d in ds[v].dims if d in tdims]
+            variables[v] = vdims[0] if len(vdims) > 0 else ''
+        times = {}
+        for d in tdims:
+            if d not in ds.variables or ds.sizes[d] == 0:
+                continue
+            units = ds[d].attrs.get('units', '')
+            if 'since' not in units:
+                continue
+            cal = ds[d].attrs.get('calendar', 'standard')
+            vals = ds[d].values[[0,-1]]
+            dates = cftime.num2date(vals, units, calendar=cal)
+            times[d] = [time_stamp(x) for x in dates]
+    return (fpath, json.dumps(variables), json.dumps(times), mtime)
+
+
+def index_files(conn, files, exp, log, ncpus=1):
+    """Adds files to fileindex table, if not already indexed or
+    if they were modified after being indexed.
+    File headers are read in parallel by ncpus processes.
+
+    Returns
+    -------
+    nfiles : int
+        Number of files added or updated, files which could not be
+        read are not counted
+    """
+    sql = "SELECT filepath, mtime FROM fileindex WHERE exp_id=?"
+    indexed = {r[0]: r[1] for r in conn.execute(sql, (exp,))}
+    toscan = [f for f in files if indexed.get(f, None)
+              != os.path.getmtime(f)]
+    log.info(f"Indexing {len(toscan)} of {len(files)} input files")
+    rows = []
+    nsaved = 0
+    if len(toscan) == 0:
+        return 0
+    nproc = max(1, min(ncpus, len(toscan)))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=nproc) as executor:
+        futures = {executor.submit(scan_file, f): f for f in toscan}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                rows.append(future.result() + (exp,))
+            except Exception as e:
+                log.error(f"Cannot index file {futures[future]}: {e}")
+            # save in batches so an interrupted scan is not lost
+            if len(rows) >= 1000:
+                nsaved += save_index(conn, rows)
+                rows = []
+    nsaved += save_index(conn, rows)
+    return nsaved
+
+
+def save_index(conn, rows):
+    """Inserts rows in fileindex table in one transaction,
+    returns number of rows saved
+    """
+    if len(rows) == 0:
+        return 0
+    cursor = conn.cursor()
+    cursor.execute('BEGIN')
+    try:
+        cursor.executemany("""INSERT OR REPLACE INTO fileindex (filepath,
+            variables, times, mtime, exp_id) VALUES (?,?,?,?,?)""", rows)
+        cursor.execute('COMMIT')
+    except Exception:
+        cursor.execute('ROLLBACK')
+        raise
+    return len(rows)
+
+
+def build_index(conn, rows, exp, log, ncpus=1):
+    """Indexes all input files matching the file patterns of the
+    filelist rows, only new or modified files are read
+
+    Parameters
+    ----------
+    conn : obj
+        DB connection object
+    rows : list(tuple)
+        Filelist rows, first item is the input files pattern/s
+    exp : str
+        Experiment id
+    log : obj
+        Logger object
+    ncpus : int
+        Number of processes used to read files (default 1)
+    """
+    patterns = set(p for r in rows for p in r[0].split())
+    files = set()
+    for p in patterns:
+        files.update(os.path.normpath(f) for f in glob.glob(p))
+    nfiles = index_files(conn, sorted(files), exp, log, ncpus)
+    log.info(f"Input files index updated: {nfiles} files")
+    return
+
+
+def match_pattern(fpath, pattern):
+    """Returns True if path matches glob pattern,
+    wildcards do not match across directories as for glob
+    """
+    fbits = fpath.split('/')
+    pbits = pattern.split('/')
+    return (len(fbits) == len(pbits) and
+        all(fnmatch.fnmatchcase(f,p) for f,p in zip(fbits,pbits)))
+
+
+def query_index(conn, pattern, exp):
+    """Returns indexed files matching file pattern
+
+    Returns
+    -------
+    index : dict
+        Dictionary {filepath: (variables, times)}
+    """
+    pattern = os.path.normpath(pattern)
+    sql = """SELECT filepath, variables, times FROM fileindex
+        WHERE exp_id=? AND filepath GLOB ?"""
+    index = {}
+    for r in conn.execute(sql, (exp, pattern)):
+        if match_pattern(r[0], pattern):
+            index[r[0]] = (json.loads(r[1]), json.loads(r[2]))
+    return index
+
+
+@click.pass_context
+def files_from_index(ctx, index, var_log):
+    """Returns all files in time range, and input variables 
+    for each file pattern, based on fileindex.
+    Works as find_all_files and check_in_range but without opening files
+    """
+    all_files = [sorted(x.keys()) for x in index]
+    missing = copy.deepcopy(ctx.obj['vin'])
+    path_vars = {}
+    time_dim = None
+    tdims = {}
+    for i,paths in enumerate(all_files):
+        path_vars[i] = []
+        variables = index[i][paths[0]][0]
+        found = [v for v in missing if v in variables]
+        for v in found:
+            path_vars[i].append(v)
+            missing.remove(v)
+            if variables[v] != '':
+                tdims.setdefault(i, variables[v])
+    if len(missing) > 0:
+        var_log.error(f"Input vars: {missing} not in files {ctx.obj['infile']}")
+    for i in path_vars.keys():
+        if ctx.obj['vin'][0] in path_vars[i]:
+            time_dim = tdims.get(i, None)
+    var_log.info(f"time var is: {time_dim}")
+    tstart = ctx.obj['tstart'].replace('T','')
+    tend = ctx.obj['tend'].replace('T','')
+    inrange_files = []
+    for i,paths in enumerate(all_files):
+        if 'fx' in ctx.obj['frequency'] or i not in tdims:
+            inrange_files.append(paths[:1])
+            continue
+        inrange = []
+        for fpath in paths:
+            tbounds = index[i][fpath][1].get(tdims[i], None)
+            if tbounds is None:
+                var_log.error(f"No {tdims[i]} in index for: {fpath}")
+            elif not(tbounds[0] > tend or tbounds[1] < tstart):
+                inrange.append(fpath)
+        inrange_files.append(inrange)
+    var_log.debug(f"Number of files in time range: {[len(x) for x in inrange_files]}")
+    return inrange_files, path_vars, time_dim
+
+
 @click.pass_context
 def get_files(ctx, var_log):
     """Returns all files in time range
-    First identifies all files with pattern/s defined for invars
+    If all files matching the pattern/s are in fileindex table uses index
+    Otherwise first identifies all files with pattern/s defined for invars
     Then retrieve time dimension and if multiple time axis are present
     Finally filter only files in time range based on file timestamp (faster)
     If this fails or multiple time axis are present reads first and
     last timestep from each file
     """
+    mop_log = ctx.obj['log']
+    patterns = ctx.obj['infile'].split()
+    try:
+        conn = db_connect(ctx.obj['database'], var_log)
+        index = [query_index(conn, p, ctx.obj['exp']) for p in patterns]
+        conn.close()
+    except sqlite3.Error as e:
+        var_log.info(f"Cannot use files index: {e}")
+        index = []
+    if len(index) > 0 and all(len(x) > 0 for x in index):
+        var_log.info("Selecting files from index")
+        inrange_files, path_vars, time_dim = files_from_index(index, var_log)
+    else:
+        inrange_files, path_vars, time_dim = search_files(var_log)
+    for i,paths in enumerate(inrange_files):
+        if paths == []:
+            mop_log.error(f"no data in requested time range for: {ctx.obj['filename']}")
+            var_log.error(f"no data in requested time range for: {ctx.obj['filename']}")
+    return inrange_files, path_vars, time_dim
+
+
+@click.pass_context
+def search_files(ctx, var_log):
+    """Returns all files in time range, searching and opening files
+    when they are not available in fileindex table
+    """
     # Returns file list for each input var and list of vars for each file pattern
     all_files, path_vars = find_all_files(var_log)
 
@@ -147,15 +431,15 @@ def get_files(ctx, var_log):
             if multiple_times is True:
                 inrange_files.append( check_in_range(paths, time_dim, var_log) )
             else:
-                inrange_files.append( check_timestamp(paths, var_log) )
+                # open only files whose timestamp cannot be parsed
+                inrange, unparsed = check_timestamp(paths, var_log)
+                if len(unparsed) > 0:
+                    inrange.extend(check_in_range(unparsed, time_dim, var_log))
+                inrange_files.append(sorted(inrange))
     except:
+        inrange_files = []
         for i,paths in enumerate(all_files):
             inrange_files.append( check_in_range(paths, time_dim, var_log) )
-
-    for i,paths in enumerate(inrange_files):
-        if paths == []:
-            mop_log.error(f"no data in requested time range for: {ctx.obj['filename']}")
-            var_log.error(f"no data in requested time range for: {ctx.obj['filename']}")
     return inrange_files, path_vars, time_dim
 
 
@@ -235,66 +519,134 @@ def get_time_dim(ctx, ds, var_log):
     return time_dim, multiple_times
 
 
+@functools.lru_cache(maxsize=None)
+def timestamp_regex(realm):
+    """Returns compiled regexes to extract the timestamp from a file
+    name, to try in order. Fields are separated by '.', '_' or '-'.
+    First dates with '-' between year and month (i.e. ice files
+    xxx.yyyy-mm.nc) or with hhmm (yyyymmddThhmm) are searched, these
+    can be followed by any field. Otherwise for ocean the timestamp is
+    the last field and for other realms, as usually atm files are
+    xxx.code_date_frequency.nc, the third field from the end.
+    """
+    field = r'[^._-]+'
+    sep = r'[._-]'
+    dated = re.compile(rf'{sep}(?P<tstamp>\d{{4}}-\d{{2}}(?:-\d{{2}})?'
+                       + rf'|\d{{8}}T\d{{0,4}})(?:{sep}{field})*$')
+    if realm == 'ocean':
+        return (dated, re.compile(rf'{sep}(?P<tstamp>{field})$'))
+    return (dated, re.compile(
+        rf'{sep}(?P<tstamp>{field}){sep}{field}{sep}{field}$'))
+
+
+# date with optional hhmm after T separator
+date_regex = re.compile(r'^(?P<date>\d+)(?:T(?P<hhmm>\d{0,4}))?$')
+
+
+def parse_timestamp(fname, regexes):
+    """Returns file timestamp as YYYYmmddHHMM integer or None if it
+    cannot be parsed, using the first of regexes matching file name
+    """
+    for regex in regexes:
+        match = regex.search(fname)
+        if match is not None:
+            break
+    if match is None:
+        return None
+    tstamp = match.group('tstamp').replace('-', '')
+    hhmm = ''
+    if 'T' in tstamp:
+        tstamp, hhmm = tstamp.split('T', 1)
+    # sometimes there's no separator between code and date,
+    # if tstamp doesn't start with a number keep last digits
+    if tstamp[:1].isdigit() is False:
+        tstamp = re.sub(r"\D", "", tstamp)
+        for n in [8, 6, 4]:
+            if len(tstamp) >= n:
+                tstamp = tstamp[-n:]
+                break
+    match = date_regex.match(f"{tstamp}T{hhmm}")
+    if match is None:
+        return None
+    tstamp = match.group('date')
+    if len(tstamp) in [3, 5, 7]:
+        #assume year is yyy
+        tstamp += '0'
+    if len(tstamp) == 4:
+        tstamp += '0101'
+    elif len(tstamp) == 6:
+        tstamp += '01'
+    if len(tstamp) != 8:
+        return None
+    return int(tstamp + match.group('hhmm').ljust(4,'0'))
+
+
+@functools.lru_cache(maxsize=64)
+def file_timestamps(realm, files):
+    """Parses timestamps of a list of files once, files are returned
+    sorted by timestamp with the timestamps as an integer array
+    (YYYYmmddHHMM), so time ranges can be found by binary search.
+
+    Parameters
+    ----------
+    realm : str
+        Realm of files, used to select timestamp regex
+    files : tuple
+        Input files paths
+
+    Returns
+    -------
+    stamps : numpy array
+        Sorted timestamps
+    sorted_files : list
+        Files with a timestamp, in same order as stamps
+    unparsed : list
+        Files whose timestamp couldn't be parsed
+    """
+    regexes = timestamp_regex(realm)
+    parsed = []
+    unparsed = []
+    for f in files:
+        tstamp = parse_timestamp(os.path.basename(f), regexes)
+        if tstamp is None:
+            unparsed.append(f)
+        else:
+            parsed.append((tstamp, f))
+    parsed.sort()
+    stamps = np.array([x[0] for x in parsed], dtype=np.int64)
+    return stamps, [x[1] for x in parsed], unparsed
+
+
 @click.pass_context
 def check_timestamp(ctx, all_files, var_log):
     """This function tries to guess the time coverage of a file based on its timestamp
-       and return the files in range. At the moment it does a lot of checks based on the realm and real examples
-       eventually it would make sense to make sure all files generated are consistent in naming
+       and return the files in range. The timestamp position depends on
+       the realm (see timestamp_regex), eventually it would make sense
+       to make sure all files generated are consistent in naming.
+
+    Returns
+    -------
+    inrange_files : list
+        Files with timestamp between sel_start and sel_end
+    unparsed : list
+        Files whose timestamp couldn't be parsed, these need
+        to be checked by check_in_range
     """
-    inrange_files = []
-    realm = ctx.obj['realm']
     var_log.info("checking files timestamp ...")
-    tstart = ctx.obj['sel_start']
-    tend = ctx.obj['sel_end']
     #if we are using a time invariant parameter, just use a file with vin
     if 'fx' in ctx.obj['frequency']:
-        inrange_files = [all_files[0]]
-    else:
-        for infile in all_files:
-            inf = infile.replace('.','_')
-            inf = inf.replace('-','_')
-            dummy = inf.split("_")
-            if realm == 'ocean':
-                tstamp = dummy[-1]
-            elif realm == 'ice':
-                tstamp = ''.join(dummy[-3:-2])
-            else:
-                tstamp = dummy[-3]
-            # usually atm files are xxx.code_date_frequency.nc
-            # sometimes there's no separator between code and date
-            # 1 make all separator _ so xxx_code_date_freq_nc
-            # then analyse date to check if is only date or codedate
-            # check if timestamp as the date time separator T
-            hhmm = ''
-            if 'T' in tstamp:
-                tstamp, hhmm = tstamp.split('T')
-            # if tstamp start with number assume is date
-            if not tstamp[0].isdigit():
-                tstamp = re.sub("\\D", "", tstamp)
-                tlen = len(tstamp)
-                if tlen >= 8:
-                    tstamp = tstamp[-8:]
-                elif 6 <= tlen < 8:
-                    tstamp = tstamp[-6:]
-                elif 4 <= tlen < 6:
-                    tstamp = tstamp[-4:]
-            tlen = len(tstamp)
-            if tlen != 8:
-                if tlen in [3, 5, 7] :
-                    #assume year is yyy
-                    tstamp += '0'
-                if len(tstamp) == 4:
-                    tstamp += '0101'
-                elif len(tstamp) == 6:
-                    tstamp += '01'
-            # if hhmm were present add them back to tstamp otherwise as 0000 
-            tstamp = tstamp + hhmm.ljust(4,'0')
-            var_log.debug(f"tstamp for {inf}: {tstamp}")
-            if tstart <= tstamp <= tend:
-                inrange_files.append(infile)
-    return inrange_files
+        return [all_files[0]], []
+    stamps, files, unparsed = file_timestamps(ctx.obj['realm'],
+                                              tuple(all_files))
+    first = np.searchsorted(stamps, int(ctx.obj['sel_start']), side='left')
+    last = np.searchsorted(stamps, int(ctx.obj['sel_end']), side='right')
+    inrange_files = files[first:last]
+    if len(unparsed) > 0:
+        var_log.info(f"Cannot parse timestamp for {len(unparsed)} files")
+    var_log.debug(f"Files in range by timestamp: {len(inrange_files)}")
+    return inrange_files, unparsed
+
 
- 
 @click.pass_context
 def check_in_range(ctx, all_files, tdim, var_log):
     """Return a list of files in time range
@@ -327,18 +679,131 @@ def check_in_range(ctx, all_files, tdim, var_log):
     return inrange_files
 
 
+# chunk plans by file pattern, variables and calculations, so files
+# are not re-opened for each row using the same pattern
+chunk_plans = {}
+
+
+@click.pass_context
+def chunk_plan(ctx, pattern, fpath, varlist, time_dim, var_log):
+    """Returns chunks to use to open input files, based on the shape,
+    dtype and netcdf chunking of each variable in the first file
+    and on the calculation/s to apply.
+    Time is split in blocks of `chunk_mem` MB (default 128), if one
+    timestep is bigger then other dimensions are split, except for
+    vertical levels used by plevinterp/level_to_height and dimensions
+    reduced by the calculation. As input files are opened as one dataset
+    the smallest chunk for a dimension among all variables is used.
+    Plans are cached by file pattern, so the first file is opened only
+    once per process. Calculations which cannot be compiled are ignored,
+    their error is reported when the variable is calculated.
+
+    Returns
+    -------
+    chunks : dict
+        Dictionary of dim: chunk size
+    """
+    target = float(ctx.obj.get('chunk_mem', 128)) * 1024**2
+    calcs = tuple(ctx.obj.get('group_calc', [ctx.obj['calculation']]))
+    key = (pattern, tuple(varlist), time_dim, calcs, target)
+    if key in chunk_plans:
+        return chunk_plans[key]
+    keep = set()
+    level_calc = False
+    for calc in calcs:
+        if calc == '':
+            continue
+        try:
+            expr = compile_calc(calc)
+        except ValueError as e:
+            var_log.warning(f"Using default chunks for {calc}: {e}")
+            continue
+        keep.update(d for d in expr.reduced_dims if isinstance(d, str))
+        if len(expr.functions & {'plevinterp', 'level_to_height'}) > 0:
+            level_calc = True
+    chunks = {}
+    with xr.open_dataset(fpath, decode_times=False) as ds:
+        for v in varlist:
+            if v not in ds.data_vars:
+                continue
+            var = ds[v]
+            vkeep = set(keep)
+            if level_calc and var.ndim == 4:
+                vkeep.add(var.dims[1])
+            disk = var.encoding.get('chunksizes', None)
+            if disk is None:
+                disk = [1] * var.ndim
+            disk = dict(zip(var.dims, disk))
+            tdims = [d for d in var.dims if d == time_dim or 'time' in d]
+            vchunks = dict(var.sizes)
+            step = var.dtype.itemsize * math.prod(
+                n for d,n in var.sizes.items() if d not in tdims)
+            # split outermost dims first if one timestep is too big
+            for d in var.dims:
+                if step <= target:
+                    break
+                if d in tdims or d in vkeep:
+                    continue
+                n = var.sizes[d]
+                size = math.ceil(n / math.ceil(step / target))
+                size = min(n, math.ceil(size / disk[d]) * disk[d])
+                step = step / n * size
+                vchunks[d] = size
+            for d in tdims:
+                nt = max(1, int(target // step))
+                nt = max(disk[d], nt // disk[d] * disk[d])
+                vchunks[d] = min(nt, var.sizes[d])
+            for d,n in vchunks.items():
+                chunks[d] = min(n, chunks.get(d, n))
+    var_log.debug(f"Chunks to open input files: {chunks}")
+    if len(chunk_plans) >= 64:
+        chunk_plans.pop(next(iter(chunk_plans)))
+    chunk_plans[key] = chunks
+    return chunks
+
+
 @click.pass_context
 def load_data(ctx, inrange_files, path_vars, time_dim, var_log):
     """Returns a dictionary of input var: xarray dataset
+    The time range is selected on each file before concatenation, so
+    only the needed timesteps are part of the dataset (see open_input).
+    If rows are processed as a group (see start_group) datasets are
+    opened with the input variables of all the group rows and cached,
+    so they are opened only once for the group.
+    Variables which are copied without calculation or resample are
+    opened without masking and scaling, see copy_var.
     """
     # preprocessing to select only variables we need to avoid
     # concatenation issues with multiple coordinates
     input_ds = {}
+    cache = ctx.obj.get('input_cache', None)
+    raw = is_copy(ctx.obj)
+    # open files in parallel only if dask is using more than one thread
+    parallel = ctx.obj.get('dask_threads', 1) > 1
+    trange = None
+    if time_dim is not None and 'fx' not in ctx.obj['frequency']:
+        trange = ctx.obj.get('group_trange',
+                             (ctx.obj['tstart'], ctx.obj['tend']))
+    patterns = ctx.obj['infile'].split()
     for i, paths in enumerate(inrange_files):
-        preselect = partial(_preselect, varlist=path_vars[i])
-        dsin = xr.open_mfdataset(paths, preprocess=preselect,
-            parallel=True, use_cftime=True) 
-        if time_dim is not None and 'fx' not in ctx.obj['frequency']:
+        if len(path_vars.get(i, [])) == 0:
+            continue
+        if cache is None:
+            chunks = chunk_plan(patterns[i], paths[0], path_vars[i],
+                time_dim, var_log)
+            dsin = open_input(paths, path_vars[i], trange, parallel,
+                chunks=chunks, use_cftime=True, mask_and_scale=not raw)
+        else:
+            key = (tuple(paths), raw)
+            if key not in cache:
+                var_log.info("Opening input files shared by group")
+                varlist = ctx.obj['group_vin']
+                chunks = chunk_plan(patterns[i], paths[0], varlist,
+                    time_dim, var_log)
+                cache[key] = open_input(paths, varlist, trange, parallel,
+                    chunks=chunks, use_cftime=True, mask_and_scale=not raw)
+            dsin = cache[key]
+        if trange is not None:
             dsin = dsin.sel({time_dim: slice(ctx.obj['tstart'],
                                              ctx.obj['tend'])})
         for v in path_vars[i]:
@@ -387,11 +852,10 @@ def check_axis(ctx, ds, inrange_files, ancil_path, var_log):
                     acnfile = ancil_path+'cice_grid_20150514.nc'
                 else:
                     acnfile = ancil_path+'cice_grid_20101208.nc'
-            acnds = xr.open_dataset(acnfile)
             # only lon so far not values
-            lon_vals = acnds[lon_name]
-            lat_vals = acnds[lat_name]
-            del acnds
+            cache_dir = f"{ctx.obj['outpath']}/ancil_cache"
+            lon_vals = load_ancil(acnfile, lon_name, cache_dir=cache_dir)
+            lat_vals = load_ancil(acnfile, lat_name, cache_dir=cache_dir)
         #if lat in file then re-read it from file
         try:
             lat_vals = ds[lat_name]
@@ -434,7 +898,8 @@ def get_cmorname(ctx, axis_name, axis, var_log, z_len=None):
             cmor_name = 'longitude'
     elif axis_name == 'z':
         #PP pressure levels derived from plevinterp
-        if 'plevinterp' in ctx.obj['calculation'] :
+        if (ctx.obj['calculation'] != '' and
+            'plevinterp' in compile_calc(ctx.obj['calculation']).functions):
             levnum = re.findall(r'\d+', ctx.obj['variable_id'])[-1]
             cmor_name = f"plev{levnum}"
         elif 'depth100' in ctx.obj['axes_modifier']:
@@ -648,15 +1113,55 @@ def require_bounds(ctx, var_log):
     Reads the requirement directly from .._coordinate.json file
     """
     fpath = f"{ctx.obj['tables_path']}/{ctx.obj['_AXIS_ENTRY_FILE']}"
-    with open(fpath, 'r') as jfile:
-        data = json.load(jfile)
-    axis_dict = data['axis_entry']
-    bnds_list = [k for k,v in axis_dict.items() 
-        if (v['must_have_bounds'] == 'yes')] 
+    bnds_list = bounds_axes(fpath, os.path.getmtime(fpath))
     var_log.debug(f"{bnds_list}")
     return bnds_list
 
 
+@functools.lru_cache(maxsize=8)
+def bounds_axes(fpath, mtime):
+    """Returns list of axes with must_have_bounds from coordinate
+    json file, cached by file path and modification time
+    """
+    axis_dict = read_json(fpath)['axis_entry']
+    return [k for k,v in axis_dict.items() 
+        if (v['must_have_bounds'] == 'yes')] 
+
+
+@click.pass_context
+def cmor_setup(ctx, var_log):
+    """Sets up CMOR and the dataset and loads grids and variable tables.
+    CMOR is set up for each file, so each file has its own CMOR log,
+    named as the variable log. CMOR keeps its log open until it is set
+    up again, so messages from different files can't be mixed in the
+    same log.
+
+    Returns
+    -------
+    tables : list
+        CMOR ids of grids and variable tables
+    """
+    logname = f"{ctx.obj['variable_id']}_{ctx.obj['table']}_{ctx.obj['tstart']}"
+    logfile = f"{ctx.obj['cmor_logs']}/{logname}"
+    cmor.setup(inpath=ctx.obj['tpath'],
+        netcdf_file_action = cmor.CMOR_REPLACE_4,
+        set_verbosity = cmor.CMOR_NORMAL,
+        exit_control = cmor.CMOR_NORMAL,
+        #exit_control=cmor.CMOR_EXIT_ON_MAJOR,
+        logfile = logfile, create_subdirectories=1)
+    var_log.info(f"CMOR log: {logfile}")
+    # Define the CMOR dataset.
+    cmor.dataset_json(ctx.obj['json_file_path'])
+    # Pass all attributes from configuration to CMOR dataset
+    for k,v in ctx.obj['attrs'].items():
+        cmor.set_cur_dataset_attribute(k, v)
+    #Load the CMIP/custom tables
+    tables = []
+    for fname in [ctx.obj['grids'], f"{ctx.obj['table']}.json"]:
+        tables.append(cmor.load_table(f"{ctx.obj['tpath']}/{fname}"))
+    return tables
+
+
 @click.pass_context
 def bnds_change(ctx, axis, var_log):
     """Returns True if calculation/resample changes bnds of specified
@@ -668,7 +1173,7 @@ def bnds_change(ctx, axis, var_log):
     if 'time' in dim and ctx.obj['resample'] != '':
         changed_bnds = True
     if calculation != '':
-        if f"sum(dim={dim})" in calculation:
+        if dim in compile_calc(calculation).reduced_dims:
             changed_bnds = True
         elif "level_to_height(var[0],levs=" in calculation and 'height' in dim:
             changed_bnds = True
@@ -878,6 +1383,12 @@ def extract_var(ctx, input_ds, tdim, in_missing, mop_log, var_log):
        dictionary of input datasets for each variable
     """
     failed = False
+    # Variables copied as they are skip fillna and time selection,
+    # already done by load_data
+    if is_copy(ctx.obj):
+        varname = ctx.obj['vin'][0]
+        array = copy_var(input_ds[varname][varname], in_missing, var_log)
+        return array, failed
     # Save the variables
     if ctx.obj['calculation'] == '':
         varname = ctx.obj['vin'][0]
@@ -896,9 +1407,11 @@ def extract_var(ctx, input_ds, tdim, in_missing, mop_log, var_log):
         var_log.info("Finished adding variables to var list")
 
         # Now try to perform the required calculation
-        array = eval(ctx.obj['calculation'])
         try:
-            array = eval(ctx.obj['calculation'])
+            calc = compile_calc(ctx.obj['calculation'])
+            var_log.debug(f"Calculation inputs: {calc.inputs}, " +
+                f"functions: {calc.functions}, reduced dims: {calc.reduced_dims}")
+            array = calc(var)
             var_log.debug(f"Variable after calculation: {array}")
         except Exception as e:
             failed = True
@@ -925,3 +1438,167 @@ def extract_var(ctx, input_ds, tdim, in_missing, mop_log, var_log):
         array = array.sel({tdim: slice(ctx.obj['tstart'], ctx.obj['tend'])})
         var_log.debug(f"{array[tdim][0].values}, {array[tdim][-1].values}")
     return array, failed
+
+
+def is_copy(row):
+    """Returns True if variable is copied from input without
+    calculation or resample
+    """
+    return row['calculation'] == '' and row['resample'] == ''
+
+
+def copy_var(array, in_missing, var_log):
+    """Returns variable opened without masking and scaling (see
+    load_data) ready to be written.
+
+    If the variable is not packed and its fill values (_FillValue and
+    missing_value) are already the missing value passed to CMOR, the
+    array is not masked and only NaNs are replaced for float data.
+    Otherwise unpacking, replacing the fill values and, for float data,
+    NaNs with in_missing are done lazily in one pass, block by block,
+    when the variable is written.
+    Integer variables which are not packed keep their type.
+
+    Parameters
+    ----------
+    array : xarray.DataArray
+        Input variable with native packing and fill value
+    in_missing : float
+        Missing value to pass to CMOR
+    var_log : logging.Logger
+        Variable log
+
+    Returns
+    -------
+    array : xarray.DataArray
+        Variable with missing values set to in_missing
+    """
+    attrs = dict(array.attrs)
+    fills = []
+    for k in ['_FillValue', 'missing_value']:
+        v = attrs.pop(k, None)
+        if v is not None:
+            fills.extend(np.atleast_1d(v).tolist())
+    scale = attrs.pop('scale_factor', None)
+    offset = attrs.pop('add_offset', None)
+    packed = scale is not None or offset is not None
+    if not packed and all(float(f) == in_missing for f in fills):
+        var_log.info("Copying variable without masking")
+        if array.dtype.kind == 'f':
+            array = array.fillna(in_missing)
+        else:
+            array = array.copy(deep=False)
+        array.attrs = attrs
+        return array
+    var_log.info(f"Unpacking variable and replacing {fills} fill values")
+    mask = None
+    for f in fills:
+        if not np.isnan(f):
+            mask = (array == f) if mask is None else mask | (array == f)
+    data = array
+    if scale is not None:
+        data = data * scale
+    if offset is not None:
+        data = data + offset
+    if data.dtype.kind == 'f':
+        if mask is not None:
+            data = data.where(~mask)
+        data = data.fillna(in_missing)
+    elif mask is not None:
+        info = np.iinfo(data.dtype)
+        if info.min <= in_missing <= info.max:
+            data = data.where(~mask, data.dtype.type(in_missing))
+        else:
+            var_log.warning(f"Missing value {in_missing} out of range for "
+                + f"{data.dtype}, keeping fill values {fills}")
+    data.attrs = attrs
+    return data
+
+
+def time_blocks(var, tdim, max_mem):
+    """Returns list of time slices to use to write variable in blocks.
+
+    Each block is sized to keep two blocks (the one being written and
+    the one prefetched) under the memory budget. If the variable is a
+    dask array block boundaries are aligned to the existing time chunks,
+    so chunks are computed only once.
+
+    Parameters
+    ----------
+    var : xarray.DataArray
+        Variable to write
+    tdim : str
+        Name of time dimension
+    max_mem : float
+        Memory budget in MB
+
+    Returns
+    -------
+    blocks : list(slice)
+        List of slices along time axis, empty if there are no timesteps
+    """
+    nsteps = var.sizes[tdim]
+    step_size = var.nbytes / max(nsteps, 1)
+    nmax = max(1, int(max_mem * 1024**2 / 2 // max(step_size, 1)))
+    if var.chunks is not None:
+        tchunks = var.chunks[var.dims.index(tdim)]
+    else:
+        tchunks = (nsteps,)
+    blocks = []
+    start = 0
+    end = 0
+    for chunk in tchunks:
+        # split chunks bigger than budget, otherwise add whole chunks
+        if chunk > nmax:
+            if end > start:
+                blocks.append(slice(start, end))
+            for i in range(end, end + chunk, nmax):
+                blocks.append(slice(i, min(i + nmax, end + chunk)))
+            end += chunk
+            start = end
+        elif end + chunk - start > nmax:
+            blocks.append(slice(start, end))
+            start = end
+            end += chunk
+        else:
+            end += chunk
+    if end > start:
+        blocks.append(slice(start, end))
+    return blocks
+
+
+@click.pass_context
+def write_var(ctx, variable_id, var, tdim, var_log):
+    """Writes variable to file using CMOR, if variable has a time
+    dimension it is computed and written in time blocks sized based
+    on `write_mem` (MB) config option, while a block is written the
+    next one is loaded.
+
+    Returns
+    -------
+    status : int
+        Status returned by last cmor.write call, 0 if nothing to write
+    """
+    if tdim is None or tdim not in var.dims:
+        return cmor.write(variable_id, var.values)
+    max_mem = float(ctx.obj.get('write_mem', 1024))
+    blocks = time_blocks(var, tdim, max_mem)
+    if len(blocks) == 0:
+        var_log.warning("No timesteps to write")
+        return 0
+    var_log.info(f"Writing {len(blocks)} block/s of max {max_mem/2} MB")
+    status = None
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as loader:
+        load = lambda sl: var.isel({tdim: sl}).values
+        future = loader.submit(load, blocks[0])
+        for i,sl in enumerate(blocks):
+            data = future.result()
+            if i+1 < len(blocks):
+                future = loader.submit(load, blocks[i+1])
+            var_log.debug(f"Writing timesteps {sl.start}-{sl.stop}")
+            status = cmor.write(variable_id, data,
+                ntimes_passed=sl.stop-sl.start)
+            del data
+            if status != 0:
+                break
+    return status
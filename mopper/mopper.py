@@ -26,7 +26,10 @@
 import click
 import logging
 import sqlite3
+import multiprocessing
+import multiprocessing.connection
 import concurrent.futures
+import dask
 import os,sys
 import warnings
 import yaml
@@ -95,21 +98,23 @@ def mop_run(ctx):
     mop_log = ctx.obj['log']
     # Open database and retrieve list of files to create
     conn = db_connect(ctx.obj['database'], mop_log)
+    conn.execute('PRAGMA journal_mode=WAL')
     sql = f"""select *,ROWID  from filelist where
         status=='unprocessed' and exp_id=='{ctx.obj['exp']}'"""
     rows = query(conn, sql, first=False)
     if len(rows) == 0:
        mop_log.info("no more rows to process")
+    # Index is built by mop setup, here only new or modified files are read
+    create_table(conn, fileindex_sql(), mop_log)
+    build_index(conn, rows, ctx.obj['exp'], mop_log, ctx.obj['ncpus'])
     # Set up pool handlers to create each file as a separate process
     mop_log.info(f"number of rows: {len(rows)}")
-    results = pool_handler(rows, ctx.obj['ncpus'])
+    # Update status in db as soon as results are available, so
+    # a new run will restart from unprocessed rows only
+    rowdict = {r[-1]: r for r in rows}
+    for results in pool_handler(rows, ctx.obj['ncpus']):
+        update_status(conn, results, rowdict, ctx.obj['outpath'])
     mop_log.info("mop run finished!\n")
-    # Summary or results and update status in db:
-    mop_log.info("RESULTS:")
-    for r in results:
-        mop_log.info(r[0])
-        cursor.execute("UPDATE filelist SET status=? WHERE rowid=?",[r[2],r[1]])
-        conn.commit()
     return
 
 
@@ -146,6 +151,7 @@ def mop_setup(ctx):
     conn = db_connect(database, mop_log)
     table_sql = filelist_sql()
     create_table(conn, table_sql, mop_log)
+    create_table(conn, fileindex_sql(), mop_log)
     populate_db(conn)
     nrows = count_rows(conn, ctx.obj['exp'], mop_log)
     tot_size = sum_file_sizes(conn)
@@ -153,6 +159,11 @@ def mop_setup(ctx):
     #write app_job.sh
     ctx = write_job(nrows)
     mop_log.info(f"app job script: {ctx.obj['app_job']}")
+    # index input files, so mop run doesn't need to open them to
+    # find variables and time ranges
+    sql = f"select distinct infile from filelist where exp_id=='{ctx.obj['exp']}'"
+    rows = query(conn, sql, first=False)
+    build_index(conn, rows, ctx.obj['exp'], mop_log, ctx.obj['ncpus'])
     # write setting to yaml file to pass to `mop run`
     fname = f"{ctx.obj['exp']}_config.yaml"
     mop_log.info("Exporting config data to yaml file")
@@ -181,26 +192,9 @@ def mop_process(ctx, mop_log, var_log):
     """
 
     default_cal = "gregorian"
-    logname = f"{ctx.obj['variable_id']}_{ctx.obj['table']}_{ctx.obj['tstart']}"
-    
-    # Setup CMOR
-    cmor.setup(inpath=ctx.obj['tpath'],
-        netcdf_file_action = cmor.CMOR_REPLACE_4,
-        set_verbosity = cmor.CMOR_NORMAL,
-        exit_control = cmor.CMOR_NORMAL,
-        #exit_control=cmor.CMOR_EXIT_ON_MAJOR,
-        logfile = f"{ctx.obj['cmor_logs']}/{logname}", create_subdirectories=1)
     
-    # Define the CMOR dataset.
-    cmor.dataset_json(ctx.obj['json_file_path'])
-    # Pass all attributes from configuration to CMOR dataset
-    for k,v in ctx.obj['attrs'].items():
-        cmor.set_cur_dataset_attribute(k, v)
-        
-    #Load the CMIP/custom tables
-    tables = []
-    tables.append(cmor.load_table(f"{ctx.obj['tpath']}/{ctx.obj['grids']}"))
-    tables.append(cmor.load_table(f"{ctx.obj['tpath']}/{ctx.obj['table']}.json"))
+    # Setup CMOR, with a log for this file, and load tables
+    tables = cmor_setup(var_log)
 
     # Select files to use and associate a path to each input variable
     inrange_files, path_vars, time_dim = get_files(var_log)
@@ -226,6 +220,9 @@ def mop_process(ctx, mop_log, var_log):
     if failed is True:
         var_log.error("Calculation failed.")
         return 1
+    if time_dim in ovar.dims and ovar.sizes[time_dim] == 0:
+        var_log.error(f"No data in time range for {ctx.obj['filename']}")
+        return 0
 
     # Define axis and variable for CMOR
     var_log.info("Defining axes...")
@@ -330,15 +327,8 @@ def mop_process(ctx, mop_log, var_log):
         return 2
     var_log.info('Writing...')
     var_log.info(f"Variable shape is {ovar.shape}")
-    status = None
-    # Write timesteps separately if variable potentially exceeding memory
-    if float(ctx.obj['file_size']) > 4000.0 and time_dim != None:
-        for i in range(ovar.shape[0]):
-            data = ovar.isel({time_dim: i}).values
-            status = cmor.write(variable_id, data, ntimes_passed=1)
-            del data
-    else:
-        status = cmor.write(variable_id, ovar.values)
+    # Write variable in time blocks to keep memory usage bounded
+    status = write_var(variable_id, ovar, time_dim, var_log)
     if status != 0:
         mop_log.error(f"Unable to write the CMOR variable: {ctx.obj['filename']}\n")
         var_log.error(f"Unable to write the CMOR variable to file\n"
@@ -368,7 +358,8 @@ def process_file(ctx, row, var_log):
     Returns
     -------
     out : tuple
-        Output status message and code and db rowid for processed file
+        Output status message and code, db rowid and path of file
+        written by CMOR (None if not written)
     """
 
     mop_log = ctx.obj['log']
@@ -379,7 +370,7 @@ def process_file(ctx, row, var_log):
         msg = "Multiple input variables but no calculation"
         mop_log.error(f"{msg}: {ctx.obj['filename']}")
         var_log.error(f"{msg}")
-        return (msg, status, row['rowid'])
+        return (msg, status, row['rowid'], None)
     var_log.info(f"\n{'-'*50}\n Processing file with details:\n")
     for k,v in row.items():
         ctx.obj[k] = v
@@ -390,6 +381,7 @@ def process_file(ctx, row, var_log):
     # return status based on return code 
     expected_file = f"{row['filepath']}/{row['filename']}"
     var_msg = f"{row['table']},{row['variable_id']},{row['tstart']},{row['tend']}"
+    outfile = None
     if ctx.obj['override'] or not os.path.exists(expected_file):
         try:
             ret = mop_process(mop_log, var_log)
@@ -413,11 +405,9 @@ def process_file(ctx, row, var_log):
             status = "processing_failed"
         else:
             #Assume processing has been successful
-            with open(f"{ctx.obj['outpath']}/success.csv",'a+') as c:
-                c.write(f"{var_msg}, {ret}\n")
-            c.close()
             #Check if output file matches what we expect
             var_log.info(f"Output file:   {ret}")
+            outfile = ret
             if ret == expected_file:
                 var_log.info(f"Expected and cmor file paths match")
                 msg = f"Successfully processed variable: {var_msg}\n"
@@ -427,16 +417,13 @@ def process_file(ctx, row, var_log):
                 var_log.info("Expected and cmor file paths do not match")
                 msg = f"Produced but file name does not match expected {var_msg}\n"
                 status = "file_mismatch"
-        if type(ret) is int:
-            with open(f"{ctx.obj['outpath']}/failed.csv",'a+') as c:
-                c.write(f"{var_msg}\n")
-            c.close()
     else :
         msg = f"Skipping because file already exists for variable: {var_msg}\n"
         var_log.info(f"filename: {expected_file}")
         status = "processed"
+        outfile = expected_file
     mop_log.info(msg)
-    return (msg, status, row['rowid'])
+    return (msg, status, row['rowid'], outfile)
 
 
 @click.pass_context
@@ -469,36 +456,252 @@ def process_row(ctx, row):
     return msg
 
 
+def group_rows(rows):
+    """Groups filelist rows which read the same input files for the
+    same time range, i.e. with same infile, sel_start and sel_end.
+    Input files are opened once per group and shared by its rows.
+
+    Returns
+    -------
+    groups : list(list)
+        List of groups, each a list of rows
+    """
+    groups = {}
+    for row in rows:
+        groups.setdefault((row[0], row[11], row[12]), []).append(row)
+    return list(groups.values())
+
+
+def estimate_mem(group, write_mem):
+    """Returns estimated memory (MB) needed to process a group of rows.
+    Data is loaded and written in time blocks of at most `write_mem`,
+    so the estimate is the smallest of file_size and write_mem for
+    each input variable of the group plus the output, as rows in a
+    group are processed one after the other.
+    """
+    nvars = len(set(v for r in group for v in r[3].split()))
+    fsize = max(float(r[14]) for r in group)
+    return min(fsize, write_mem) * (nvars + 1)
+
+
+def group_size(group):
+    """Returns size (MB) of data read and written by a group of rows,
+    based on file_size of each row, used to start the biggest groups
+    first. Unlike estimate_mem this is not capped by write_mem.
+    """
+    nvars = len(set(v for r in group for v in r[3].split()))
+    fsize = max(float(r[14]) for r in group)
+    return fsize * (nvars + 1)
+
+
+@click.pass_context
+def start_group(ctx, group):
+    """Sets up context to share input datasets among the rows
+    of a group, load_data opens all the group input variables once.
+    Only the opened datasets are shared, data is still read and
+    computed separately by each row.
+    """
+    if len(group) > 1:
+        ctx.obj['group_vin'] = sorted(set(v for r in group
+                                          for v in r[3].split()))
+        ctx.obj['group_calc'] = sorted(set(r[16] for r in group))
+        ctx.obj['group_trange'] = (min(r[9] for r in group),
+                                   max(r[10] for r in group))
+        ctx.obj['input_cache'] = {}
+    return
+
+
 @click.pass_context
-def pool_handler(ctx, rows, ncpus):
-    """Sets up the concurrent future pool executor and submits
-    rows from filelist db table to process_row. Each row represents a file
-    to process. 
+def end_group(ctx):
+    """Closes input datasets shared by group rows and clears
+    interpolation weights computed for the group
+    """
+    ctx.obj.pop('group_vin', None)
+    ctx.obj.pop('group_calc', None)
+    ctx.obj.pop('group_trange', None)
+    cache = ctx.obj.pop('input_cache', {})
+    for ds in cache.values():
+        ds.close()
+    weights_cache.clear()
+    return
+
+
+@click.pass_context
+def set_scheduler(ctx, nthreads):
+    """Sets dask scheduler for a worker process, workers already use
+    one core each so dask uses the synchronous scheduler, or a
+    thread pool limited to nthreads if there are spare cores.
+    """
+    ctx.obj['dask_threads'] = nthreads
+    if nthreads > 1:
+        pool = concurrent.futures.ThreadPoolExecutor(nthreads)
+        dask.config.set(scheduler='threads', pool=pool)
+    else:
+        dask.config.set(scheduler='synchronous')
+    return
+
+
+def worker_loop(conn, nthreads):
+    """Main loop of a worker process. Receives groups of rows to process
+    from pool_handler through a pipe, reports when it starts processing
+    each row and sends back the process_row() output. Sends 'end' when
+    the group is completed and exits when it receives None.
+    """
+    set_scheduler(nthreads)
+    while True:
+        group = conn.recv()
+        if group is None:
+            break
+        start_group(group)
+        for row in group:
+            conn.send(('start', row[-1]))
+            try:
+                msg = process_row(row)
+            except Exception as e:
+                msg = (f"Could not process row: {e}\n", 'processing_failed',
+                       row[-1], None)
+            conn.send(('done', msg))
+        end_group()
+        conn.send(('end', None))
+    conn.close()
+    return
+
+
+def start_worker(nthreads=1):
+    """Starts a worker process running worker_loop.
+    Workers are forked so they inherit the click context,
+    nthreads is the number of threads the worker dask can use.
 
     Returns
     -------
-    result_futures : list
-        list of process_row() outputs returned by futures, these are 
-        tuples with status message and code, and rowid
+    worker : dict
+        Worker process, pipe connection to worker, rows of the group
+        still to complete and the group estimated memory, rowid of
+        row being processed
+    """
+    mp_ctx = multiprocessing.get_context('fork')
+    conn, child_conn = mp_ctx.Pipe()
+    proc = mp_ctx.Process(target=worker_loop,
+        args=(child_conn, nthreads), daemon=True)
+    proc.start()
+    child_conn.close()
+    return {'proc': proc, 'conn': conn, 'todo': None, 'mem': 0.0,
+            'current': None}
+
+
+@click.pass_context
+def pool_handler(ctx, rows, ncpus, max_retries=1):
+    """Starts ncpus worker processes and sends them rows from filelist
+    db table to process with process_row. Each row represents a file
+    to process. Rows reading the same input files and time range are
+    grouped and sent to the same worker, so input files are opened once.
+
+    Groups are submitted starting from the largest and only while the
+    sum of their estimated memory stays under the job memory ('nmem'),
+    smaller groups are used to fill up the available memory.
+
+    Each worker runs in its own process, if a worker dies (i.e. segfault
+    in CMOR or netCDF) the worker is replaced and the group rows which
+    weren't completed are re-queued. The row being processed is re-tried
+    up to max_retries times, then it is marked as 'crashed'.
+
+    Yields
+    ------
+    results : list
+        list of process_row() outputs completed since last yield, these
+        are tuples with status message and code, and rowid
     """
     mop_log = ctx.obj['log']
-    executor = concurrent.futures.ProcessPoolExecutor(max_workers=ncpus)
-    futures = []
-    for row in rows:
-    # Using submit with a list instead of map lets you get past the first exception
-    # Example: https://stackoverflow.com/a/53346191/7619676
-        future = executor.submit(process_row, row)
-        futures.append(future)
-    # Wait for all results
-    concurrent.futures.wait(futures)
-
-# After a segfault is hit for any child process (i.e. is "terminated abruptly"), the process pool becomes unusable
-# and all running/pending child processes' results are set to broken
-    result_futures = []
-    for future in futures:
-        try:
-            mop_log.info(f"{future.result()}")
-            result_futures.append(future.result())
-        except concurrent.futures.process.BrokenProcessPool:
-            mop_log.info("process broken")
-    return result_futures
+    write_mem = float(ctx.obj.get('write_mem', 1024))
+    max_mem = float(ctx.obj.get('nmem', ncpus * ctx.obj['mem_per_cpu'])) * 1024
+    pending = group_rows(rows)
+    mop_log.info(f"Rows grouped by input files: {len(pending)} groups")
+    pending.sort(key=group_size, reverse=True)
+    mop_log.info(f"Memory available to process rows: {max_mem} MB")
+    nworkers = min(ncpus, len(pending))
+    # share spare cores among workers dask, unless set in config
+    nthreads = int(ctx.obj.get('dask_threads', ncpus // max(nworkers, 1)))
+    mop_log.info(f"Starting {nworkers} workers with {nthreads} dask threads")
+    workers = [start_worker(nthreads) for i in range(nworkers)]
+    retries = {}
+    used_mem = 0.0
+    while True:
+        # replace idle workers which exited unexpectedly
+        for i,w in enumerate(workers):
+            if w['todo'] is None and not w['proc'].is_alive():
+                w['conn'].close()
+                workers[i] = start_worker(nthreads)
+        busy = [w for w in workers if w['todo'] is not None]
+        # send biggest groups fitting in available memory to idle workers,
+        # always send one if nothing is running
+        i = 0
+        idle = [w for w in workers if w['todo'] is None]
+        while i < len(pending) and len(idle) > 0:
+            group_mem = estimate_mem(pending[i], write_mem)
+            if used_mem + group_mem <= max_mem or len(busy) == 0:
+                w = idle.pop()
+                group = pending.pop(i)
+                w['todo'] = list(group)
+                w['mem'] = group_mem
+                w['current'] = None
+                w['conn'].send(group)
+                used_mem += group_mem
+                busy.append(w)
+            else:
+                i += 1
+        if len(busy) == 0:
+            break
+        waitlist = [w['conn'] for w in busy] + [w['proc'].sentinel for w in busy]
+        multiprocessing.connection.wait(waitlist)
+        results = []
+        for w in busy:
+            try:
+                while w['conn'].poll():
+                    label, msg = w['conn'].recv()
+                    if label == 'start':
+                        w['current'] = msg
+                    elif label == 'done':
+                        mop_log.info(f"{msg}")
+                        results.append(msg)
+                        w['todo'] = [r for r in w['todo'] if r[-1] != msg[2]]
+                        w['current'] = None
+                    else:
+                        used_mem -= w['mem']
+                        w['todo'] = None
+                        break
+            except (EOFError, OSError):
+                pass
+            if w['todo'] is None or w['proc'].is_alive():
+                continue
+            # worker died while processing group
+            used_mem -= w['mem']
+            w['proc'].join()
+            code = w['proc'].exitcode
+            # only the row being processed counts a retry, if the worker
+            # died before starting a row this is the next one in group
+            todo = list(w['todo'])
+            current = w['current']
+            if current is None and len(todo) > 0:
+                current = todo[0][-1]
+            for row in [r for r in todo if r[-1] == current]:
+                todo.remove(row)
+                retries[current] = retries.get(current, 0) + 1
+                msg = (f"Worker crashed (exit code {code}) processing: "
+                       + f"{row[5]},{row[4]},{row[9]},{row[10]}\n")
+                mop_log.error(msg)
+                if retries[current] <= max_retries:
+                    todo.append(row)
+                else:
+                    results.append((msg, 'crashed', current, None))
+            if len(todo) > 0:
+                mop_log.info(f"Re-queuing rows {[r[-1] for r in todo]}")
+                pending.append(todo)
+                pending.sort(key=group_size, reverse=True)
+            w['conn'].close()
+            workers[workers.index(w)] = start_worker(nthreads)
+        if len(results) > 0:
+            yield results
+    for w in workers:
+        w['conn'].send(None)
+        w['proc'].join()
+    return
@@ -40,6 +40,8 @@ from datetime import datetime#, timedelta
 from dateutil.relativedelta import relativedelta
 from json.decoder import JSONDecodeError
 from mopdb.mopdb_utils import query
+from mopper.calc_utils import parse_delta
+from mopper.calculations import read_json
 
 
 def write_var_map(outpath, table, matches):
@@ -149,14 +151,13 @@ def write_table(ctx, table, vardict, select):
     """Write CMOR table in working directory
        Includes only selected variables and adds deflate levels.
     """
-    new = copy.deepcopy(vardict)
-    for k in vardict['variable_entry'].keys():
-        if k not in select:
-            new['variable_entry'].pop(k)
-        else:
-            new['variable_entry'][k]['deflate'] = 1
-            new['variable_entry'][k]['deflate_level'] = ctx.obj['deflate_level']
-            new['variable_entry'][k]['shuffle'] = 1
+    # copy only the selected variables, vardict is not modified
+    new = {k: v for k,v in vardict.items() if k != 'variable_entry'}
+    new['variable_entry'] = {}
+    for k,v in vardict['variable_entry'].items():
+        if k in select:
+            new['variable_entry'][k] = dict(v, deflate=1, shuffle=1,
+                deflate_level=ctx.obj['deflate_level'])
     tjson = f"{ctx.obj['tpath']}/{table}.json"
     with open(tjson,'w') as f:
         json.dump(new, f, indent=4, separators=(',', ': '))
@@ -204,6 +205,27 @@ def filelist_sql():
     return sql
 
 
+def fileindex_sql():
+    """Returns sql to define fileindex table, this lists for each input
+    file: variables (as json {var: time dimension}), first and last
+    value of each time dimension (as json {tdim: [first, last]}) and
+    the file modification time
+
+    Returns
+    -------
+    sql : str
+        SQL style string defining fileindex table
+    """
+    sql = '''create table if not exists fileindex(
+            filepath text,
+            exp_id text,
+            variables text,
+            times text,
+            mtime real,
+            primary key(exp_id,filepath))'''
+    return sql
+
+
 @click.pass_context
 def write_job(ctx, nrows):
     """
@@ -415,11 +437,11 @@ def adjust_size(opts, insize):
     resample = opts['resample']
     grid_size = insize
     if 'plevinterp' in calc:
-        try:
-            plevnum = calc.split(',')[-1]
-        except:
-            raise('check plevinterp calculation definition plev probably missing')
-        plevnum = float(plevnum.replace(')',''))
+        # levnum is the third argument of plevinterp
+        match = re.search(r'plevinterp\((?:[^,]*,){2}\s*(\d+)', calc)
+        if match is None:
+            raise ValueError('check plevinterp calculation definition plev probably missing')
+        plevnum = float(match.group(1))
         grid_size = float(insize)/float(opts['levnum'])*plevnum
     return grid_size
 
@@ -627,9 +649,9 @@ def define_files(ctx, cursor, opts, mp):
          finish = start + relativedelta(days=1)
          tstep_dict['fx'] = tstep_dict['day']
     while (start < finish):
-        tstep = eval(f"relativedelta({tstep_dict[frq][0]})")
-        half_tstep = eval(f"relativedelta({tstep_dict[frq][1]})")
-        delta = eval(f"relativedelta({interval})")
+        tstep = parse_delta(tstep_dict[frq][0])
+        half_tstep = parse_delta(tstep_dict[frq][1])
+        delta = parse_delta(interval)
         newtime = min(start+delta, finish)
         tstart = start + half_tstep 
         opts['tstart'] = tstart.strftime('%4Y%m%dT%H%M')
@@ -644,6 +666,48 @@ def define_files(ctx, cursor, opts, mp):
     return
 
 
+def update_status(conn, results, rowdict, outpath):
+    """Updates status of processed rows in filelist table in one
+    transaction. Successful and failed files are also added to
+    success.csv and failed.csv, as used by update_db.py 
+
+    Parameters
+    ----------
+    conn : obj 
+        DB connection object
+    results : list(tuple)
+        Output of process_row: status message, status, rowid and path
+        of file written
+    rowdict : dict
+        Filelist rows by rowid
+    outpath : str
+        Output directory where csv files are saved
+    """
+    cursor = conn.cursor()
+    cursor.execute('BEGIN')
+    try:
+        cursor.executemany("UPDATE filelist SET status=? WHERE rowid=?",
+            [(r[1], r[2]) for r in results])
+        cursor.execute('COMMIT')
+    except Exception:
+        cursor.execute('ROLLBACK')
+        raise
+    success = []
+    failed = []
+    for msg, status, rowid, outfile in results:
+        row = rowdict[rowid]
+        var_msg = f"{row[5]},{row[4]},{row[9]},{row[10]}"
+        if status in ['processed', 'file_mismatch']:
+            success.append(f"{var_msg}, {outfile}\n")
+        else:
+            failed.append(f"{var_msg}\n")
+    for fname, lines in [('success.csv', success), ('failed.csv', failed)]:
+        if len(lines) > 0:
+            with open(f"{outpath}/{fname}", 'a+') as c:
+                c.writelines(lines)
+    return
+
+
 def count_rows(conn, exp, mop_log):
     """Returns number of files to process
     """
@@ -69,6 +69,7 @@ def get_summary(rows):
         'processed': "file already processed",
         'unknown_return_code': "processing failed with unidentified error",
         'processing_failed': "processing failed with unidentified error",
+        'crashed': "worker process crashed while processing file",
         'calculation_failed': "processing failed with unidentified error",
         'file_mismatch': "produced but file name does not match expected",
         'cmor_error': "cmor variable definition or write failed",
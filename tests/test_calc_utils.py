@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# Copyright 2023 ARC Centre of Excellence for Climate Extremes
+# author: Paola Petrelli <paola.petrelli@utas.edu.au>
+# author: Sam Green <sam.green@unsw.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+import numpy as np
+import xarray as xr
+from dateutil.relativedelta import relativedelta
+from mopper.calc_utils import compile_calc, parse_delta
+
+
+def test_compile_calc():
+    calc = compile_calc("var[0].sum(dim='depth') - var[1]*2")
+    assert calc.inputs == [0, 1]
+    assert calc.whole_var is False
+    assert calc.reduced_dims == ['depth']
+    assert compile_calc("var[0].sum(dim='depth') - var[1]*2") is calc
+    calc = compile_calc("tos_degC(var[0].isel(time=0))")
+    assert calc.functions == {'tos_degC'}
+    assert calc.reduced_dims == ['time']
+    a = xr.DataArray(np.ones((2,3)), dims=['time', 'depth'])
+    out = compile_calc("var[0].sum(dim='depth') - var[1]")([a, a])
+    assert (out.values == 2).all()
+
+
+@pytest.mark.parametrize('text', ["os.remove('x')", "__import__('os')",
+    "var[0].__class__", "lambda x: x", "var[0] if 1 else 0",
+    "save_ancil('x.nc', 'var', 'x')", "AncilDataset('x.nc').close()"])
+def test_compile_calc_invalid(text):
+    with pytest.raises(ValueError):
+        compile_calc(text)
+
+
+def test_parse_delta():
+    assert parse_delta('months=1') == relativedelta(months=1)
+    assert parse_delta('hours=1.5') == relativedelta(hours=1.5)
+    assert parse_delta('days=0.25') == relativedelta(days=0.25)
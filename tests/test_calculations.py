@@ -15,3 +15,293 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+
+import pytest
+import os
+import click
+import logging
+import dask
+import numpy as np
+import xarray as xr
+import pandas as pd
+import mopper.calculations as calc
+from unittest import mock
+from mopper.calculations import (vertical_interp, WeightsCache, tileAve,
+    block_resample, tile_weights, sum_tiles, fracLut, tileFracExtract,
+    IceTransportCalculations, grid_key, ocean_floor, load_ancil)
+
+
+def test_vertical_interp():
+    rng = np.random.default_rng(0)
+    # pressure decreasing with level as on model levels
+    pres = np.sort(rng.uniform(1000., 100000., (3, 4, 10)), axis=-1)[..., ::-1]
+    var = rng.normal(size=(3, 4, 10))
+    plev = np.array([100000., 85000., 50000., 25000., 500.])
+    out = vertical_interp(var, pres, plev)
+    assert out.shape == (3, 4, 5)
+    for i,j in np.ndindex(3, 4):
+        expected = np.interp(plev, pres[i,j,::-1], var[i,j,::-1])
+        np.testing.assert_allclose(out[i,j], expected, rtol=1e-5)
+    # log pressure
+    out = vertical_interp(var, pres, plev, log=True)
+    expected = np.interp(np.log(plev), np.log(pres[0,0,::-1]), var[0,0,::-1])
+    np.testing.assert_allclose(out[0,0], expected, rtol=1e-5)
+    # levels below surface are masked
+    out = vertical_interp(var, pres, plev, mask_below=True)
+    below = plev > pres[..., :1]
+    assert (np.isnan(out) == below).all()
+    # level not on last axis
+    out = vertical_interp(np.moveaxis(var, -1, 1), np.moveaxis(pres, -1, 1),
+        plev, axis=1)
+    np.testing.assert_allclose(np.moveaxis(out, 1, -1),
+        vertical_interp(var, pres, plev), rtol=1e-6)
+    # columns with pressure increasing with level
+    pres[0,0] = pres[0,0,::-1]
+    var[0,0] = var[0,0,::-1]
+    out = vertical_interp(var, pres, plev)
+    expected = np.interp(plev, pres[0,0], var[0,0])
+    np.testing.assert_allclose(out[0,0], expected, rtol=1e-5)
+
+
+def test_weights_cache():
+    cache = WeightsCache(max_mem=1)
+    a = np.zeros((1024, 64), dtype=np.float32)
+    cache.put('a', (a, None))
+    cache.put('b', (a, None))
+    cache.put('c', (a, None))
+    assert cache.get('a') is not None
+    # least recently used are evicted first
+    cache.put('d', (a, a, a))
+    assert cache.get('b') is None
+    assert cache.get('c') is None
+    assert cache.get('a') is not None
+    assert cache.get('d') is not None
+    assert cache.size <= 1024**2
+    # without lru new items are not added when full
+    cache = WeightsCache(max_mem=1, lru=False)
+    for k in 'abcde':
+        cache.put(k, (a, None))
+    assert cache.get('a') is not None
+    assert cache.get('e') is None
+    cache.clear()
+    assert cache.get('a') is None and cache.size == 0
+
+
+def test_plevinterp_weights():
+    rng = np.random.default_rng(0)
+    dims = ('time', 'model_level_number', 'lat', 'lon')
+    pres = np.sort(rng.uniform(1000., 100000., (4, 10, 8, 6)), axis=1)
+    pmod = xr.DataArray(pres[:,::-1], dims=dims).chunk({'time': 1})
+    ta = xr.DataArray(rng.normal(size=pres.shape), dims=dims).chunk(
+        {'time': 1})
+    ua = ta * 2.
+    plev = np.array([85000., 50000., 25000.])
+    # weights_mem fits only 3 of the 4 blocks
+    nbytes = sum(x.nbytes for x in calc.interp_weights(pres[0], plev,
+        axis=0) if x is not None)
+    obj = {'var_log': logging.getLogger('test'),
+           'weights_mem': 3.5 * nbytes / 1024**2}
+    calc.weights_cache.clear()
+    with click.Context(click.Command('mop'), obj=obj), \
+         dask.config.set(scheduler='synchronous'), \
+         mock.patch('mopper.calculations.get_plev', return_value=plev), \
+         mock.patch('mopper.calculations.interp_weights',
+                    wraps=calc.interp_weights) as weights:
+        out1 = calc.plevinterp(ta, pmod, 3).compute()
+        assert weights.call_count == 4
+        # second variable on same pressure re-uses cached weights
+        out2 = calc.plevinterp(ua, pmod, 3).compute()
+        assert weights.call_count == 5
+    calc.weights_cache.clear()
+    np.testing.assert_allclose(out2.values, 2. * out1.values, rtol=1e-5)
+    expected = vertical_interp(ta.values[1], pres[1,::-1], plev, axis=0)
+    np.testing.assert_allclose(out1.values[1], expected, rtol=1e-5)
+
+
+def test_tileAve():
+    rng = np.random.default_rng(0)
+    dims = ('time', 'pseudo_level_1', 'lat', 'lon')
+    coords = {'time': np.arange(3), 'pseudo_level_1': np.arange(1, 6)}
+    var = xr.DataArray(rng.normal(size=(3, 5, 2, 4)), dims=dims,
+        coords=coords)
+    frac = xr.DataArray(rng.uniform(size=(1, 5, 2, 4)), dims=dims,
+        coords={'time': [0], 'pseudo_level_1': np.arange(1, 6)})
+    expected = (var.values * frac.values).sum(axis=1)
+    out = tileAve(var, frac, 1)
+    assert out.dims == ('time', 'lat', 'lon')
+    np.testing.assert_allclose(out.values, expected)
+    # stays lazy and multiplies by land fraction
+    out = tileAve(var.chunk({'time': 1}), frac, 0.5)
+    assert out.chunks is not None
+    np.testing.assert_allclose(out.values, expected * 0.5)
+
+
+
+def test_tile_weights():
+    tiles = xr.DataArray(np.arange(1, 18), dims='pseudo_level_1')
+    w = tile_weights(tiles, [[1, 3], [9], []])
+    assert w.dims == ('pseudo_level_1', 'group')
+    assert w.sum(dim='pseudo_level_1').values.tolist() == [2, 1, 0]
+    assert w.sel(pseudo_level_1=3).values.tolist() == [1, 0, 0]
+    # missing tiles are ignored unless all are missing
+    var = xr.DataArray([[1., np.nan, 2.] + [0.]*14, [np.nan]*17],
+        dims=('x', 'pseudo_level_1'), coords={'pseudo_level_1': tiles})
+    out = sum_tiles(var, w)
+    np.testing.assert_allclose(out.values, [[3., 0., 0.],
+        [np.nan, np.nan, np.nan]])
+
+
+def test_fracLut():
+    rng = np.random.default_rng(0)
+    dims = ('time', 'pseudo_level_1', 'lat', 'lon')
+    var = xr.DataArray(rng.uniform(size=(2, 17, 3, 4)), dims=dims,
+        coords={'pseudo_level_1': np.arange(1, 18)}).chunk({'time': 1})
+    landfrac = 0.5
+    vals = var.values
+    out = fracLut(var, landfrac, 0)
+    assert out.dims == dims
+    assert out.chunks is not None
+    assert out.pseudo_level_1.values.tolist() == [1, 2, 3, 4]
+    tiles = [1, 2, 3, 4, 5, 6, 7, 11, 14]
+    expected = np.stack([vals[:,[t-1 for t in tiles]].sum(axis=1),
+        np.zeros((2, 3, 4)), vals[:,8], vals[:,14]], axis=1)
+    np.testing.assert_allclose(out.values, expected * landfrac)
+    # non-woody vegetation only
+    out = fracLut(var, landfrac, 1)
+    np.testing.assert_allclose(out.values[:,0],
+        vals[:,[5, 6, 10]].sum(axis=1) * landfrac)
+    np.testing.assert_allclose(out.values[:,3], 0.)
+    # each tile in list is added once
+    out = tileFracExtract(var, landfrac, [5, 8])
+    np.testing.assert_allclose(out.values,
+        (vals[:,4] + vals[:,7]) * landfrac)
+
+
+def test_block_resample():
+    rng = np.random.default_rng(0)
+    # starts at midnight and ends mid-day, so first and last days
+    # are incomplete intervals
+    t = xr.date_range('2000-01-01', periods=6*24*3+7, freq='10min',
+        calendar='360_day', use_cftime=True)
+    var = xr.DataArray(rng.normal(size=(len(t), 3)), dims=('time', 'x'),
+        coords={'time': t}).chunk({'time': 100})
+    for stats in ['mean', 'max', 'sum']:
+        out = block_resample(var, 'D', 'time', stats)
+        expected = getattr(var.resample(time='D', origin='start_day',
+            closed='right'), stats)()
+        np.testing.assert_allclose(out.values, expected.values)
+        assert (out.time.values == (expected.time.to_index()
+            + pd.Timedelta(hours=12)).values).all()
+    # months have variable length
+    assert block_resample(var, 'M', 'time') is None
+
+
+def test_line_transports():
+    rng = np.random.default_rng(0)
+    shape = (2, 26, 300, 360)
+    tx = xr.DataArray(rng.normal(size=shape).astype(np.float32),
+        dims=('time', 'st_ocean', 'yt_ocean', 'xu_ocean'))
+    ty = xr.DataArray(rng.normal(size=shape).astype(np.float32),
+        dims=('time', 'st_ocean', 'yu_ocean', 'xt_ocean'))
+    calc = IceTransportCalculations('')
+    out = calc.lineTransports(tx.chunk({'time': 1}), ty.chunk({'time': 1}))
+    assert out.dims == ('time', 'oline')
+    assert out.oline.values.tolist() == calc.lines
+    # sums over the boxes previously hard-coded in lineTransports
+    box = lambda v, i0, i1, j0, j1: v[:, :, j0:j1+1, i0:i1+1].sum(
+        axis=(1, 2, 3))
+    x = tx.values
+    y = ty.values
+    expected = box(y, 292, 300, 271, 271) + box(x, 300, 300, 260, 271)
+    np.testing.assert_allclose(out.sel(oline='barents_opening'), expected,
+        rtol=1e-4)
+    expected = (box(y, 266, 268, 243, 243) + box(x, 268, 268, 240, 243)
+        + box(y, 269, 272, 239, 239) + box(x, 272, 272, 239, 239))
+    np.testing.assert_allclose(out.sel(oline='iceland_faroe_channel'),
+        expected, rtol=1e-4)
+    # top 25 levels and positive transport only
+    expected = box(np.clip(x[:, :25], 0, None), 124, 124, 128, 145)
+    np.testing.assert_allclose(
+        out.sel(oline='pacific_equatorial_undercurrent'), expected, rtol=1e-4)
+    np.testing.assert_allclose(out.sel(oline='english_channel'), 0.)
+    # no line with segments
+    with pytest.raises(ValueError):
+        calc.sum_lines(tx, ty, ['english_channel'], 'oline')
+    # sea ice lines on 2D fields
+    out = calc.fill_transports(tx[:, 0], ty[:, 0])
+    assert out.siline.values.tolist() == calc.ice_lines
+    expected = (x[:, 0, 279, 267] + y[:, 0, 278, 268:285].sum(axis=-1))
+    np.testing.assert_allclose(out.sel(siline='fram_strait'), expected,
+        rtol=1e-4)
+
+
+def test_grid_key():
+    area = xr.DataArray(np.ones((3, 4)), dims=('yt_ocean', 'xt_ocean'),
+        coords={'yt_ocean': np.arange(3.), 'xt_ocean': np.arange(4.)})
+    # same grid read from different files, with different time
+    area1 = area.chunk().assign_coords(time=1.)
+    area2 = area.chunk().assign_coords(time=2.)
+    assert grid_key('area_t', area1) == grid_key('area_t', area2)
+    assert grid_key('area_t', area) != grid_key('area_t',
+        area.assign_coords(xt_ocean=np.arange(4.) + 0.5))
+
+
+def test_ocean_floor():
+    rng = np.random.default_rng(0)
+    coords = {'time': [0, 1], 'st_ocean': [5., 15., 30., 50.],
+              'yt_ocean': [-10., 0., 10.], 'xt_ocean': [100., 101.]}
+    vals = rng.normal(size=(2, 4, 3, 2))
+    # number of ocean levels in each column, 0 is land
+    nlev = np.array([[4, 3], [1, 0], [2, 4]])
+    levels = np.arange(4)[:, None, None]
+    vals = np.where(levels < nlev, vals, np.nan)
+    temp = xr.DataArray(vals, dims=list(coords), coords=coords,
+        name='temp').chunk({'time': 1})
+    out = ocean_floor(temp)
+    assert out.dims == ('time', 'yt_ocean', 'xt_ocean')
+    expected = np.take_along_axis(vals, np.clip(nlev - 1, 0, None)[None,
+        None], axis=1)[:, 0]
+    expected[:, nlev == 0] = np.nan
+    np.testing.assert_array_equal(out.values, expected)
+    # other variable on same grid with a different mask
+    salt = xr.DataArray(np.where(levels < 1, vals, np.nan),
+        dims=list(coords), coords=coords, name='salt').chunk({'time': 1})
+    out = ocean_floor(salt)
+    np.testing.assert_array_equal(out.values, vals[:, 0])
+    # bottom index from kmt
+    kmt = xr.DataArray(nlev, dims=('yt_ocean', 'xt_ocean'))
+    out = ocean_floor(temp, kmt=kmt)
+    np.testing.assert_array_equal(out.values, expected)
+
+
+def test_load_ancil(tmp_path):
+    lat = xr.DataArray(np.linspace(-80., 80., 5), dims='ny',
+        attrs={'units': 'degrees_north'})
+    ds = xr.Dataset({'tarea': (('ny', 'nx'), np.arange(15.).reshape(5, 3),
+        {'units': 'm2'})}, coords={'lat': lat})
+    ds.to_netcdf(tmp_path / 'grid.nc')
+    cache_dir = str(tmp_path / 'ancil_cache')
+    calc.ancil_arrays.clear()
+    # file relative to base, saved as .npy the first time
+    var = load_ancil('grid.nc', 'tarea', base=str(tmp_path),
+        cache_dir=cache_dir)
+    assert isinstance(var.data, np.memmap)
+    assert len([f for f in os.listdir(cache_dir) if f.endswith('.npy')]) == 2
+    xr.testing.assert_identical(var, ds['tarea'])
+    # loaded once per process
+    assert load_ancil('grid.nc', 'tarea', base=str(tmp_path),
+        cache_dir=cache_dir) is var
+    # other processes map saved files
+    calc.ancil_arrays.clear()
+    with mock.patch('mopper.calculations.save_ancil') as save:
+        var = load_ancil(str(tmp_path / 'grid.nc'), 'tarea',
+            cache_dir=cache_dir)
+        save.assert_not_called()
+    xr.testing.assert_identical(var, ds['tarea'])
+    # without cache_dir variable is read from file
+    calc.ancil_arrays.clear()
+    var = load_ancil('grid.nc', 'lat', base=str(tmp_path))
+    assert not isinstance(var.data, np.memmap)
+    xr.testing.assert_identical(var, ds['lat'])
+    calc.ancil_arrays.clear()
+
@@ -16,15 +16,259 @@
 # limitations under the License.
 
 import pytest
-from mop_utils import *
+import logging
+import click
+import os
+import numpy as np
+import xarray as xr
+from mopper.mop_utils import *
+from mopper.setup_utils import fileindex_sql
+from mopdb.mopdb_utils import create_table
 
 try:
     import unittest.mock as mock
 except ImportError:
     import mock
 
-def test_check_timestamp(ctx, files, inrange):
-    with mock.patch('config_log', side_effect = lambda: logging.getLogger()):
-    out1 = check_timestamp(ctx, files, log)
-    #assert out1 = inrange
-    assert True
+@pytest.mark.parametrize('fname,realm,tstamp', [
+    ('ocean_month.nc-20000101', 'ocean', 200001010000),
+    ('aiihca.pa-101001_mon.nc', 'atmos', 101001010000),
+    ('umnsa_slv_20160101T0130.nc', 'atmos', 201601010130),
+    ('cw323a.pm1995dec.nc', 'atmos', None),
+    ('iceh_m.1980-06.nc', 'ice', 198006010000),
+    ('iceh.1980-06-daily.nc', 'ice', 198006010000),
+    ('iceh_d.1980-06-15.nc', 'seaIce', 198006150000),
+    ('ocean_scalar.nc', 'ocean', None),
+    ('aiihca.paa1jan_mon.nc', 'atmos', None)])
+def test_parse_timestamp(fname, realm, tstamp):
+    assert parse_timestamp(fname, timestamp_regex(realm)) == tstamp
+
+
+def test_file_timestamps():
+    files = ('/data/1980-01/ice/iceh_m.1980-11.nc',
+             '/data/ice/iceh_m.1980-02.nc', '/data/ice/iceh_m.nc')
+    stamps, sfiles, unparsed = file_timestamps('ice', files)
+    # paths are not used to parse, files are sorted by timestamp
+    assert stamps.tolist() == [198002010000, 198011010000]
+    assert sfiles == [files[1], files[0]]
+    assert unparsed == [files[2]]
+
+
+def test_check_timestamp():
+    log = logging.getLogger('test')
+    files = [f"/data/ice/iceh_m.1980-{m:02d}.nc" for m in range(1, 13)]
+    files.append('/data/ice/iceh_m.nc')
+    obj = {'frequency': 'mon', 'realm': 'seaIce',
+           'sel_start': '198006010000', 'sel_end': '198008160000'}
+    with click.Context(click.Command('mop'), obj=obj):
+        inrange, unparsed = check_timestamp(files, log)
+        assert inrange == files[5:8]
+        assert unparsed == ['/data/ice/iceh_m.nc']
+        # time invariant variables use first file
+        obj['frequency'] = 'fx'
+        assert check_timestamp(files, log) == ([files[0]], [])
+
+
+def test_copy_var():
+    log = logging.getLogger('test')
+    vals = np.array([[1., -999., 3.], [np.nan, 5., 1e20]], dtype=np.float32)
+    # fill value already equal to missing value, only NaNs are replaced
+    var = xr.DataArray(vals, dims=('time', 'x'),
+        attrs={'_FillValue': np.float32(1e20), 'units': 'K'})
+    out = copy_var(var, float(np.float32(1e20)), log)
+    assert out.attrs == {'units': 'K'}
+    assert '_FillValue' in var.attrs
+    assert out.dtype == np.float32
+    np.testing.assert_array_equal(out.values, np.array([[1., -999., 3.],
+        [1e20, 5., 1e20]], dtype=np.float32))
+    # _FillValue and missing_value differ, both and NaN are replaced
+    var.attrs['missing_value'] = np.float32(-999.)
+    out = copy_var(var, 1e20, log)
+    assert out.dtype == np.float32
+    np.testing.assert_array_equal(out.values, np.array([[1., 1e20, 3.],
+        [1e20, 5., 1e20]], dtype=np.float32))
+    # no fill value, NaNs are replaced
+    var.attrs = {}
+    out = copy_var(var, 1e20, log)
+    assert not np.isnan(out.values).any()
+    # packed variable
+    packed = xr.DataArray(np.array([10, -32767, 20], dtype=np.int16),
+        dims='x', attrs={'_FillValue': np.int16(-32767),
+        'scale_factor': 0.5, 'add_offset': 1.})
+    out = copy_var(packed, 1e20, log)
+    np.testing.assert_allclose(out.values, [6., 1e20, 11.])
+    # integer variable keeps its type
+    ints = xr.DataArray(np.array([1, -1, 3], dtype=np.int32), dims='x',
+        attrs={'_FillValue': np.int32(-1)})
+    out = copy_var(ints, -999., log)
+    assert out.dtype == np.int32
+    np.testing.assert_array_equal(out.values, [1, -999, 3])
+
+
+def test_chunk_plan(tmp_path):
+    log = logging.getLogger('test')
+    fpath = str(tmp_path / 'ocean_month.nc-20000101')
+    ds = xr.Dataset({'temp': (('time', 'st_ocean', 'yt', 'xt'),
+        np.zeros((12, 5, 10, 20), dtype=np.float32))})
+    ds.to_netcdf(fpath)
+    pattern = str(tmp_path / 'ocean_month.nc-*')
+    obj = {'calculation': 'not a (valid calc', 'chunk_mem': 0.002}
+    with click.Context(click.Command('mop'), obj=obj):
+        with mock.patch('xarray.open_dataset', wraps=xr.open_dataset) as op:
+            # invalid calculation falls back to default chunks
+            chunks = chunk_plan(pattern, fpath, ['temp'], 'time', log)
+            assert chunks['time'] == 1
+            assert chunks['st_ocean'] < 5
+            # plan is reused for other rows with same pattern
+            assert chunk_plan(pattern, fpath, ['temp'], 'time', log) == chunks
+            assert op.call_count == 1
+        # levels are not split for plevinterp
+        obj['calculation'] = 'plevinterp(var[0], var[1], 19)'
+        chunks = chunk_plan(pattern, fpath, ['temp'], 'time', log)
+        assert chunks['st_ocean'] == 5
+
+
+def test_time_blocks():
+    var = xr.DataArray(np.zeros((10, 100)), dims=('time', 'x'))
+    # 800 bytes per step, budget of two blocks of 3 steps
+    max_mem = 3 * 800 * 2 / 1024**2
+    blocks = time_blocks(var, 'time', max_mem)
+    assert blocks == [slice(0,3), slice(3,6), slice(6,9), slice(9,10)]
+    # blocks are aligned to dask chunks, bigger chunks are split
+    var = var.chunk({'time': (4, 4, 2)})
+    blocks = time_blocks(var, 'time', max_mem)
+    assert blocks == [slice(0,3), slice(3,4), slice(4,7), slice(7,8),
+                      slice(8,10)]
+    blocks = time_blocks(var, 'time', max_mem * 8/3)
+    assert blocks == [slice(0,8), slice(8,10)]
+    assert time_blocks(var.isel(time=slice(0,0)), 'time', max_mem) == []
+
+
+def test_write_var():
+    log = logging.getLogger('test')
+    vals = np.arange(40.).reshape(10, 4)
+    var = xr.DataArray(vals, dims=('time', 'x')).chunk({'time': 3})
+    written = []
+    def write(var_id, data, ntimes_passed=None):
+        written.append((data, ntimes_passed))
+        return 0
+    obj = {'write_mem': 3 * 32 * 2 / 1024**2}
+    with click.Context(click.Command('mop'), obj=obj), \
+         mock.patch('mopper.mop_utils.cmor') as cmor_mock:
+        cmor_mock.write.side_effect = write
+        assert write_var(1, var, 'time', log) == 0
+        # each block is written once, in order
+        assert [x[1] for x in written] == [3, 3, 3, 1]
+        np.testing.assert_array_equal(np.concatenate([x[0] for x in written]),
+            vals)
+        # write stops at first error
+        written.clear()
+        cmor_mock.write.side_effect = lambda *args, **kwargs: -1
+        assert write_var(1, var, 'time', log) == -1
+        assert cmor_mock.write.call_count == 5
+        # nothing to write
+        cmor_mock.write.reset_mock()
+        assert write_var(1, var.isel(time=slice(0,0)), 'time', log) == 0
+        cmor_mock.write.assert_not_called()
+
+
+def ocean_files(path, months):
+    """Writes monthly ocean files, returns their paths
+    """
+    files = []
+    for m in months:
+        ds = xr.Dataset({'temp': (('time', 'xt_ocean'), np.zeros((1, 3)))},
+            coords={'time': ('time', [30.*(m-1)],
+            {'units': 'days since 2000-01-01', 'calendar': 'noleap'})})
+        fpath = f"{path}/ocean_month.nc-2000{m:02d}01"
+        ds.to_netcdf(fpath)
+        files.append(fpath)
+    return files
+
+
+def test_index_files(tmp_path):
+    log = logging.getLogger('test')
+    files = ocean_files(tmp_path, [1, 2])
+    conn = db_connect(str(tmp_path / 'mopper.db'), log)
+    create_table(conn, fileindex_sql(), log)
+    assert index_files(conn, files, 'exp1', log) == 2
+    index = query_index(conn, f"{tmp_path}/ocean_month.nc-*", 'exp1')
+    assert index[files[1]] == ({'temp': 'time', 'time': 'time'},
+                               {'time': ['200001310000', '200001310000']})
+    # unchanged files are not read again
+    assert index_files(conn, files, 'exp1', log) == 0
+    # modified files are read again, files which can't be read skipped
+    os.utime(files[0], (0, 0))
+    bad = tmp_path / 'ocean_month.nc-20000301'
+    bad.write_text('not netcdf')
+    assert index_files(conn, files + [str(bad)], 'exp1', log) == 1
+    # build_index indexes all files matching filelist patterns
+    build_index(conn, [(f"{tmp_path}/ocean_month.nc-2000020*",)], 'exp2',
+        log)
+    index = query_index(conn, f"{tmp_path}/ocean_month.nc-*", 'exp2')
+    assert list(index) == [files[1]]
+    conn.close()
+
+
+
+def test_get_files(tmp_path):
+    log = logging.getLogger('test')
+    files = ocean_files(tmp_path, [1, 2, 3])
+    database = str(tmp_path / 'mopper.db')
+    conn = db_connect(database, log)
+    create_table(conn, fileindex_sql(), log)
+    index_files(conn, files, 'exp1', log)
+    conn.close()
+    obj = {'log': log, 'database': database, 'exp': 'exp1',
+           'infile': f"{tmp_path}/ocean_month.nc-*", 'vin': ['temp'],
+           'frequency': 'mon', 'tstart': '20000101T0000',
+           'tend': '20000215T0000', 'filename': 'temp.nc'}
+    with click.Context(click.Command('mop'), obj=obj):
+        # files are selected from index without opening them
+        with mock.patch('xarray.open_dataset') as op, \
+             mock.patch('mopper.mop_utils.search_files') as search:
+            inrange, path_vars, tdim = get_files(log)
+            op.assert_not_called()
+            search.assert_not_called()
+        assert inrange == [files[:2]]
+        assert path_vars == {0: ['temp']}
+        assert tdim == 'time'
+        # files not in index are searched
+        obj['exp'] = 'exp2'
+        with mock.patch('mopper.mop_utils.search_files',
+                        return_value=([files[:1]], {0: ['temp']}, 'time')
+                        ) as search:
+            assert get_files(log) == ([files[:1]], {0: ['temp']}, 'time')
+            search.assert_called_once()
+        # missing index table
+        obj['database'] = str(tmp_path / 'other.db')
+        with mock.patch('mopper.mop_utils.search_files',
+                        return_value=([files[:1]], {0: ['temp']}, 'time')
+                        ) as search:
+            get_files(log)
+            search.assert_called_once()
+
+
+@pytest.mark.parametrize('parallel', [False, True])
+def test_open_input(tmp_path, parallel):
+    files = ocean_files(tmp_path, [1, 2, 3])
+    # files without timesteps in range are not combined
+    ds = open_input(files, ['temp'], ('20000115T0000', '20000315T0000'),
+        parallel, use_cftime=True)
+    assert [t.strftime('%Y%m%d') for t in ds.time.values] == ['20000131',
+        '20000302']
+    ds.close()
+    # no file in range
+    ds = open_input(files, ['temp'], ('20010101T0000', '20010201T0000'),
+        parallel, use_cftime=True)
+    assert ds.sizes['time'] == 0
+    ds.close()
+    # closing dataset closes all files
+    ds = open_input(files, ['temp'], parallel=parallel, use_cftime=True)
+    assert ds.sizes['time'] == 3
+    cache = xr.backends.file_manager.FILE_CACHE
+    opened = lambda: [k for k in cache.keys() if str(tmp_path) in str(k)]
+    ds.load()
+    assert len(opened()) == 3
+    ds.close()
+    assert opened() == []
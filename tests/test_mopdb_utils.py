@@ -43,3 +43,83 @@ def test_add_var(varlist_rows, idx, db_log):
     match = ("tas", "", "K")
     vlist = add_var(vlist, varlist_rows[idx], match, db_log)
     assert vlist == vlistout
+
+
+def test_mapping_index(session, setup_access_db, db_log):
+    session.execute('''INSERT INTO mapping VALUES ("rlus", 
+        "fld_s02i207 fld_s02i201", "var[0]-var[1]", "W m-2",
+        "time lat lon", "mon", "atmos", "area: time: mean", "up",
+        "CMIP6_Amon", "CM2", "", "cm000")''')
+    session.connection.commit()
+    mapidx = MappingIndex(session.connection)
+    assert mapidx.cmorname('fld_s03i236', 'CM2', 'mon', db_log) == (
+        'tas', 'CMIP6_Amon')
+    assert mapidx.cmorname('fld_s03i237', 'CM2', 'mon', db_log) == ('', '')
+    assert mapidx.by_id[('fld_s03i236', 'mon', 'CM2')] == ('tas', '', 'K')
+    assert mapidx.by_frq[('fld_s03i236', 'mon')] == ('tas', '', 'K')
+    assert mapidx.by_version[('fld_s03i236', 'CM2')] == ('tas', '', 'K')
+    assert [r[0] for r in mapidx.calculations('fld_s02i201')] == ['rlus']
+    assert mapidx.calculations('fld_s03i236') == []
+
+
+def varlist_row(name, frequency, fname):
+    return [name, "", "", "time lat lon", frequency, "atmos",
+        "area: time: mean", "", "float32", "110592", "12", fname,
+        "long name", ""]
+
+
+def test_parse_vars(session, setup_access_db, db_log):
+    session.execute('''INSERT INTO mapping VALUES ("huss", "fld_s03i237",
+        "", "1", "time lat lon", "day", "atmos", "area: time: mean",
+        "", "CMIP6_day", "ESM1.5", "", "cm000")''')
+    session.execute('''INSERT INTO mapping VALUES ("ps", "fld_s00i409",
+        "", "Pa", "time lat lon", "mon", "atmos", "area: time: mean",
+        "", "CMIP6_Amon", "CM2", "", "cm000")''')
+    session.connection.commit()
+    rows = [["name", "cmor_var"] + [""]*12,
+        varlist_row("fld_s03i236", "mon", "cm000a.pm"),
+        varlist_row("fld_s03i237", "day", "cm000a.pd"),
+        varlist_row("fld_s00i409", "day", "cm000a.pd"),
+        varlist_row("fld_s00i000", "mon", "cm000a.pm")]
+    vars_list, no_ver, no_frq, no_match, stash_vars = parse_vars(
+        session.connection, rows, 'CM2', db_log)
+    # exact match, match without version, without frequency, no match
+    assert [(r[0], r[1], r[2]) for r in vars_list] == [
+        ("fld_s03i236", "tas", "K")]
+    assert [(r[0], r[1], r[2]) for r in no_ver] == [
+        ("fld_s03i237", "huss", "1")]
+    assert [(r[0], r[1], r[2]) for r in no_frq] == [
+        ("fld_s00i409", "ps", "Pa")]
+    assert [r[0] for r in no_match] == ["fld_s00i000"]
+    assert stash_vars == ["fld_s03i236-mon", "fld_s03i237-day",
+        "fld_s00i409-day", "fld_s00i000-mon"]
+
+
+def test_potential_vars(session, setup_access_db, db_log):
+    session.execute('''INSERT INTO mapping VALUES ("rlus", 
+        "fld_s02i207 fld_s02i201", "var[0]-var[1]", "W m-2",
+        "time lat lon", "mon", "atmos", "area: time: mean", "up",
+        "CMIP6_Amon", "CM2", "", "cm000")''')
+    # only one input available
+    session.execute('''INSERT INTO mapping VALUES ("rlds", 
+        "fld_s02i207 fld_s02i208", "var[0]+var[1]", "W m-2",
+        "time lat lon", "mon", "atmos", "area: time: mean", "down",
+        "CMIP6_Amon", "CM2", "", "cm000")''')
+    # name includes fld_s02i201 but it is a different input
+    session.execute('''INSERT INTO mapping VALUES ("rsus", 
+        "fld_s02i2011", "var[0]*2", "W m-2",
+        "time lat lon", "mon", "atmos", "area: time: mean", "up",
+        "CMIP6_Amon", "CM2", "", "cm000")''')
+    session.connection.commit()
+    rows = [varlist_row("fld_s02i207", "mon", "cm000a.pm"),
+        varlist_row("fld_s02i201", "mon", "cm000a.pn")]
+    vars_list, no_ver, no_frq, no_match, stash_vars = parse_vars(
+        session.connection, rows, 'CM2', db_log)
+    pot_vars, pot_varnames = potential_vars(session.connection, rows,
+        stash_vars, db_log)
+    assert pot_varnames == {"rlus"}
+    assert len(pot_vars) == 1
+    line = list(pot_vars)[0]
+    assert line[:3] == ("rlus", "fld_s02i207 fld_s02i201", "var[0]-var[1]")
+    assert line[5] == "mon"
+    assert sorted(line[-1].split()) == ["cm000a.pm", "cm000a.pn"]
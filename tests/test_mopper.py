@@ -15,3 +15,91 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import pytest
+import os
+import click
+import logging
+from unittest import mock
+import numpy as np
+import xarray as xr
+import mopper.mopper as mop
+
+
+def filelist_row(rowid, infile='/data/atm/*.nc', vin='fld_s03i236',
+                 size=100.):
+    row = [''] * 27 + [rowid]
+    row[0] = infile
+    row[3] = vin
+    row[4] = f"var{rowid}"
+    row[5] = 'CMIP6_Amon'
+    row[9], row[10] = '20000101T0000', '20001231T2359'
+    row[11], row[12] = '200001010000', '200012312359'
+    row[14] = str(size)
+    return tuple(row)
+
+
+def test_group_size():
+    small = [filelist_row(1, size=100.), filelist_row(2, size=10.)]
+    big = [filelist_row(3, infile='/data/ocn/*.nc', size=8000.)]
+    bigger = [filelist_row(4, infile='/data/ice/*.nc', size=6000.,
+        vin='a b')]
+    assert mop.group_rows(small + big + bigger) == [small, big, bigger]
+    # memory estimate is capped by write_mem, sort key is not
+    assert mop.estimate_mem(big, 1024) == mop.estimate_mem(bigger, 1024) / 1.5
+    groups = sorted([small, big, bigger], key=mop.group_size, reverse=True)
+    assert groups == [bigger, big, small]
+
+
+def test_pool_handler_crash(tmp_path):
+    marker = tmp_path / 'crashed'
+    def process_row(row):
+        rowid = row[-1]
+        # row 2 crashes once, row 4 always crashes
+        if rowid == 2 and not marker.exists():
+            marker.touch()
+            os._exit(1)
+        if rowid == 4:
+            os._exit(1)
+        return (f"done {rowid}", 'processed', rowid, None)
+    rows = [filelist_row(i) for i in range(1, 6)]
+    obj = {'log': logging.getLogger('test'), 'mem_per_cpu': 1}
+    results = {}
+    with click.Context(click.Command('mop'), obj=obj), \
+         mock.patch('mopper.mopper.process_row', side_effect=process_row):
+        for res in mop.pool_handler(rows, 1):
+            for msg, status, rowid, outfile in res:
+                assert rowid not in results
+                results[rowid] = status
+    assert results == {1: 'processed', 2: 'processed', 3: 'processed',
+                       4: 'crashed', 5: 'processed'}
+
+
+def test_group_load_data(tmp_path):
+    log = logging.getLogger('test')
+    for m in [1, 2]:
+        ds = xr.Dataset({v: (('time', 'xt_ocean'), np.zeros((1, 3)))
+            for v in ['temp', 'salt']}, coords={'time': ('time',
+            [31.*(m-1)], {'units': 'days since 2000-01-01'})})
+        ds.to_netcdf(tmp_path / f"ocean_month.nc-2000{m:02d}01")
+    infile = f"{tmp_path}/ocean_month.nc-*"
+    files = sorted(str(f) for f in tmp_path.iterdir())
+    group = [filelist_row(1, infile=infile, vin='temp'),
+             filelist_row(2, infile=infile, vin='salt')]
+    obj = {'infile': infile, 'frequency': 'mon', 'calculation': '',
+           'resample': '', 'tstart': '20000101T0000',
+           'tend': '20001231T2359'}
+    with click.Context(click.Command('mop'), obj=obj), \
+         mock.patch('mopper.mop_utils.open_input',
+                    wraps=mop.open_input) as op:
+        mop.start_group(group)
+        temp = mop.load_data([files], {0: ['temp']}, 'time', log)['temp']
+        salt = mop.load_data([files], {0: ['salt']}, 'time', log)['salt']
+        # files are opened once with the variables of all rows
+        assert op.call_count == 1
+        assert sorted(op.call_args.args[1]) == ['salt', 'temp']
+        assert salt.sizes['time'] == 2
+        xr.testing.assert_identical(temp, salt)
+        assert len(obj['input_cache']) == 1
+        mop.end_group()
+        assert 'input_cache' not in obj
+
@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# Copyright 2023 ARC Centre of Excellence for Climate Extremes
+# author: Paola Petrelli <paola.petrelli@utas.edu.au>
+# author: Sam Green <sam.green@unsw.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sqlite3
+from mopper.setup_utils import filelist_sql, update_status
+
+
+def test_update_status(tmp_path):
+    conn = sqlite3.connect(':memory:', isolation_level=None)
+    conn.execute(filelist_sql())
+    rowdict = {}
+    for i in range(3):
+        row = ['x'] * 26
+        row[4], row[5], row[13] = f"var{i}", 'CMIP6_Amon', 'unprocessed'
+        rowid = conn.execute(f"INSERT INTO filelist VALUES ({','.join('?'*26)})",
+            row).lastrowid
+        rowdict[rowid] = tuple(row) + (rowid,)
+    results = [("ok", 'processed', 1, '/out/var0.nc'),
+               ("mismatch", 'file_mismatch', 2, '/out/var1_v2.nc'),
+               ("failed", 'cmor_error', 3, None)]
+    # statuses of all results are saved in one transaction
+    update_status(conn, results, rowdict, tmp_path)
+    status = conn.execute("SELECT rowid, status FROM filelist").fetchall()
+    assert status == [(1, 'processed'), (2, 'file_mismatch'),
+                      (3, 'cmor_error')]
+    # path written by CMOR is saved in success.csv
+    success = (tmp_path / 'success.csv').read_text().splitlines()
+    assert success == ['CMIP6_Amon,var0,x,x, /out/var0.nc',
+                       'CMIP6_Amon,var1,x,x, /out/var1_v2.nc']
+    assert (tmp_path / 'failed.csv').read_text() == 'CMIP6_Amon,var2,x,x\n'
+    conn.close()